@@ -6,6 +6,8 @@ from common.token import login_required, Permission
 from common.image_uploader import generate_uptoken
 from common.hooks import hook_cms
 from common.models import Article, Comment, SubComment
+from common.counter import comment_counter, sub_comment_counter, track_article
+from common.feed import invalidate_feed
 from front.models import FrontUser
 
 cms_common_bp = Blueprint("cms_common", __name__, url_prefix="/cms/common")
@@ -138,8 +140,21 @@ class MultiPutView(Resource):
         if not item:
             return source_error(message="找不到")
 
+        if category == "article":
+            with track_article(item):
+                item.status = 1 - item.status
+                db.session.commit()
+            invalidate_feed(item.board_id)
+            return success()
+
         item.status = 1 - item.status
         db.session.commit()
+
+        amount = 1 if item.status else -1
+        if category == "comment":
+            comment_counter.increase((item.article_id, ), amount=amount)
+        elif category == "sub_comment":
+            sub_comment_counter.increase((item.comment_id, ), amount=amount)
         return success()
 
 
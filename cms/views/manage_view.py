@@ -7,7 +7,9 @@ from ..forms import BoardForm
 from common.token import login_required, Permission
 from common.models import Board, Article
 from common.hooks import hook_cms
-from common.cache import article_cache
+from common.cache import article_cache, board_local
+from common.counter import article_counter, track_article
+from common.feed import invalidate_feed
 from front.models import FrontUser
 from ..models import CMSUser
 
@@ -94,6 +96,8 @@ class BoardView(Resource):
             db.session.add(board)
             db.session.commit()
 
+        # 板块数量很少，直接清空所有进程中的板块缓存
+        board_local.invalidate()
         return success()
 
     @staticmethod
@@ -268,7 +272,7 @@ class ArticleView(Resource):
         status = request.args.get("status", 1, type=int)
 
         articles = Article.query.filter_by(status=status)
-        total = articles.with_entities(func.count(Article.id)).scalar()
+        total = article_counter.get(status, 0, 0)
         articles = articles.order_by(Article.created.desc())[offset: offset + limit]
         return self.generate_response(articles, total)
 
@@ -286,17 +290,15 @@ class ArticleView(Resource):
             return source_error(message="文章不存在")
 
         is_deleted = article.status == 0
-        if mode == "add":
-            if is_deleted:
-                return params_error(message="文章已经是删除状态的了")
-            article.status = 0
-
-        elif mode == "sub":
-            if not is_deleted:
-                return params_error(message="文章状态正常")
-            article.status = 1
+        if mode == "add" and is_deleted:
+            return params_error(message="文章已经是删除状态的了")
+        elif mode == "sub" and not is_deleted:
+            return params_error(message="文章状态正常")
 
-        db.session.commit()
+        with track_article(article):
+            article.status = 0 if mode == "add" else 1
+            db.session.commit()
+        invalidate_feed(article.board_id)
         return success()
 
     @staticmethod
@@ -305,15 +307,17 @@ class ArticleView(Resource):
         resp = Data()
         resp.total = total
         resp.articles = []
+        articles = Article.load_relations(articles)
+        properties = Article.get_property_caches(article_cache, articles)
         for article in articles:
             data = Data()
             data.article_id = article.id
             data.title = article.title
             data.created = article.created.timestamp()
-            data.content = article.content
+            data.content = article.get_excerpt()
             data.quality = article.quality
 
-            article_properties = article.get_property_cache(article_cache)
+            article_properties = properties[article.id]
             data.likes = article_properties.get("likes", -1)
             data.views = article_properties.get("views", -1)
             data.comments = article_properties.get("comments", -1)
@@ -329,11 +333,7 @@ class ArticleView(Resource):
             data.author.avatar = article.author.avatar
             data.author.gender = article.author.gender
 
-            if article.images:
-                data.images = article.images.split(",")
-            else:
-                data.images = []
-
+            data.images = article.image_list
             data.tags = [tag.marshal(Data) for tag in article.tags]
 
             resp.articles.append(data)
@@ -0,0 +1,95 @@
+from redis import RedisError
+import atexit
+import threading
+import time
+
+
+class Aggregator(object):
+    """
+    进程内的写后聚合器，在内存中按键累计次数与成员，每隔interval秒交给flush_func一次性写入redis
+    view_aggregator = Aggregator(flush_func, interval=1, max_size=10000)
+    view_aggregator.add(article_id, user_id)
+    flush_func(counts, members): counts为键到次数的映射，members为键到成员集合的映射
+    缓冲区中的键与成员总数达到max_size时，由调用add的线程立即写入，进程退出时也会写入一次
+    写入失败的数据放回缓冲区，放回后总数不超过max_retry_size时保留，默认为max_size的4倍
+    写入失败后interval秒内不再由add触发写入，交给定时线程重试
+    """
+
+    def __init__(self, flush_func, interval=1, max_size=10000, max_retry_size=None):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_size = max_size
+        self.max_retry_size = max_retry_size or max_size * 4
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.members = {}
+        self.size = 0
+        self.retry_at = 0
+        self.thread = None
+        atexit.register(self.flush)
+
+    def start(self):
+        """
+        确保当前进程有一个定时写入的线程，gunicorn fork出的子进程中会重新创建
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print("聚合器写入失败...{}".format(e))
+
+    def add(self, key, member=None):
+        self.start()
+        with self.lock:
+            self.merge({key: 1}, {key: {member}} if member is not None else {})
+            full = self.size >= self.max_size and time.monotonic() >= self.retry_at
+        if full:
+            self.flush()
+
+    def merge(self, counts, members):
+        """
+        把数据合并进缓冲区，调用方需要持有锁
+        """
+        for key, count in counts.items():
+            if key not in self.counts:
+                self.counts[key] = 0
+                self.size += 1
+            self.counts[key] += count
+        for key, values in members.items():
+            current = self.members.setdefault(key, set())
+            self.size -= len(current)
+            current.update(values)
+            self.size += len(current)
+
+    def flush(self):
+        """
+        取出整个缓冲区并写入，写入失败时在max_retry_size允许的情况下放回缓冲区，等待下一次写入
+        :return: 写入的键数量
+        """
+        with self.lock:
+            if not self.counts:
+                return 0
+            counts, members = self.counts, self.members
+            self.counts, self.members, self.size = {}, {}, 0
+        try:
+            self.flush_func(counts, members)
+        except RedisError as e:
+            with self.lock:
+                self.retry_at = time.monotonic() + self.interval
+                if self.size + len(counts) + sum(len(values) for values in members.values()) <= self.max_retry_size:
+                    self.merge(counts, members)
+                    print("聚合器写入失败，数据已放回缓冲区...{}".format(e))
+                else:
+                    print("聚合器写入失败，缓冲区已满，丢弃【{}】个键...{}".format(len(counts), e))
+            return 0
+        return len(counts)
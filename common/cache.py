@@ -1,16 +1,321 @@
 import redis
 import json as js
+import os
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
 from conf import IPHOST
 
 
+# 散列表存在时才增减字段，并刷新保活时间
+# 散列表不存在时什么都不做，返回nil，由调用方从数据库重建
+# 脚本只访问一个键，在redis集群中也可以执行
+HINCRBY_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local res = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if tonumber(ARGV[3]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return res
+"""
+
+# 只增减散列表中已经存在的字段，ARGV[1]为增量，其余为字段名，返回增减的字段数
+HINCRBY_EXISTING = """
+local count = 0
+for i = 2, #ARGV do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[1])
+        count = count + 1
+    end
+end
+return count
+"""
+
+# 锁的值与令牌一致时才删除，避免锁超时后删掉其他进程重新加上的锁
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# 切换用户对文章/评论的点赞状态，并把变化追加到等待落库的stream中，刷新用户点赞集合的保活时间
+# KEYS[1]: 用户点过赞的文章/评论id集合，KEYS[2]: stream
+# ARGV: 文章/评论id，用户id，时间戳，保活时间，是否跳过存在判断，集合中的占位元素
+# 集合不存在且没有要求跳过判断时返回nil，由调用方从数据库重建后再次执行，否则返回切换后的status
+# stream中的消息以"用户id:文章/评论id"为键，落库时按(用户, 文章/评论)找到对应的赞
+TOGGLE_APPRECIATION = """
+if ARGV[5] == '0' and redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local status = 1
+if redis.call('SREM', KEYS[1], ARGV[1]) == 1 then
+    status = 0
+else
+    redis.call('SADD', KEYS[1], ARGV[1])
+end
+redis.call('SADD', KEYS[1], ARGV[6])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('XADD', KEYS[2], '*', 'item_id', ARGV[2] .. ':' .. ARGV[1], 'value', cjson.encode({
+    id = ARGV[1], user_id = ARGV[2], status = status, created = tonumber(ARGV[3])}))
+return status
+"""
+
+
+class LocalCache(object):
+    """
+    进程内的LRU缓存，放在redis之前作为一级缓存，只用于很少变化的数据
+    超过ttl秒的数据视为过期，超过maxsize时淘汰最久未使用的数据
+    invalidate会通过redis pub/sub通知所有进程一起删除对应的数据，订阅断开时依靠ttl兜底
+    """
+    CHANNEL = "local_cache:invalidate"
+    # 命名空间到LocalCache的映射，收到失效通知时按命名空间分发
+    registry = {}
+    listener = None
+    listener_lock = threading.Lock()
+    # 订阅失败后，过一段时间再重试，避免每次读取都去连接redis
+    listener_retry = 0
+
+    def __init__(self, redis_client, namespace, maxsize=1024, ttl=60):
+        self.redis = redis_client
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        LocalCache.registry[namespace] = self
+
+    def listen(self):
+        """
+        确保当前进程有一个订阅失效通知的线程
+        gunicorn fork出的子进程中线程不会被复制，is_alive为False，会在子进程中重新订阅
+        """
+        listener = LocalCache.listener
+        if listener is not None and listener.is_alive():
+            return
+        with LocalCache.listener_lock:
+            listener = LocalCache.listener
+            if listener is not None and listener.is_alive() or time.monotonic() < LocalCache.listener_retry:
+                return
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.CHANNEL: LocalCache.on_message})
+                LocalCache.listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+            except redis.RedisError:
+                LocalCache.listener_retry = time.monotonic() + 30
+
+    @staticmethod
+    def on_message(message):
+        data = js.loads(message["data"])
+        local = LocalCache.registry.get(data["namespace"])
+        if local:
+            local.drop(*data["keys"])
+
+    def get(self, key, loader):
+        """
+        取出key对应的数据，不存在或过期时调用loader()加载，loader返回None时不缓存
+        """
+        self.listen()
+        with self.lock:
+            item = self.data.get(key)
+            if item and item[0] > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+        value = loader()
+        if value is not None:
+            self.set_many({key: value})
+        return value
+
+    def get_many(self, keys, loader):
+        """
+        批量取出数据，缺失的key统一交给loader(missing)加载，loader返回key到数据的字典
+        :return: key到数据的字典，loader中也不存在的key不会出现在结果中
+        """
+        self.listen()
+        res, missing = {}, []
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                item = self.data.get(key)
+                if item and item[0] > now:
+                    self.data.move_to_end(key)
+                    res[key] = item[1]
+                else:
+                    missing.append(key)
+            self.hits += len(res)
+            self.misses += len(missing)
+        if missing:
+            loaded = loader(missing)
+            self.set_many(loaded)
+            res.update(loaded)
+        return res
+
+    def set_many(self, mapping):
+        expire = time.monotonic() + self.ttl
+        with self.lock:
+            for key, value in mapping.items():
+                self.data[key] = (expire, value)
+                self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def drop(self, *keys):
+        """
+        只删除当前进程中的数据，不传key时清空整个命名空间
+        """
+        with self.lock:
+            if not keys:
+                self.data.clear()
+            for key in keys:
+                self.data.pop(key, None)
+
+    def invalidate(self, *keys):
+        """
+        删除当前进程中的数据，并通知其他进程删除，不传key时清空整个命名空间
+        key会经过json序列化，因此只支持字符串与数字
+        """
+        self.drop(*keys)
+        try:
+            self.redis.publish(self.CHANNEL, js.dumps({"namespace": self.namespace, "keys": keys}))
+        except redis.RedisError:
+            pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0
+        }
+
+
+class StreamQueue(object):
+    """
+    基于redis stream与消费者组的持久化队列，消息在落库成功后才ack，保证至少一次写入
+    多个进程可以同时消费同一个队列，消费者异常退出后，它已读取未ack的消息可以被其他消费者认领
+    ack后的消息会从stream中删除，因此stream的长度等于已读取未ack的数量加上还未读取的数量
+    """
+
+    def __init__(self, redis_client, name, group):
+        self.redis = redis_client
+        self.name = name
+        self.group = group
+        self.consumer = "{}-{}".format(socket.gethostname(), os.getpid())
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(self.name, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            # 消费者组已经存在
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, count=1000):
+        """
+        读取还没有被任何消费者读取过的消息
+        :return: [(消息id, 字段字典)]
+        """
+        res = self.redis.xreadgroup(self.group, self.consumer, {self.name: ">"}, count=count)
+        return res[0][1] if res else []
+
+    def claim(self, min_idle=60000, count=1000):
+        """
+        认领被读取后超过min_idle毫秒仍未ack的消息，通常是消费者在落库前异常退出留下的
+        """
+        pending = self.redis.xpending_range(self.name, self.group, "-", "+", count)
+        ids = [item["message_id"] for item in pending if item["time_since_delivered"] >= min_idle]
+        if not ids:
+            return []
+        return [(message_id, fields) for message_id, fields in
+                self.redis.xclaim(self.name, self.group, self.consumer, min_idle, ids) if fields]
+
+    def ack(self, *ids):
+        if not ids:
+            return
+        with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.xack(self.name, self.group, *ids)
+            pipeline.xdel(self.name, *ids)
+            pipeline.execute()
+
+    def prune(self, min_idle=3600000):
+        """
+        删除空闲超过min_idle毫秒且没有未ack消息的消费者，进程重启后以旧的"主机名-进程号"命名的消费者不会再出现
+        :return: 删除的消费者数量
+        """
+        consumers = [consumer["name"] for consumer in self.redis.xinfo_consumers(self.name, self.group)
+                     if consumer["pending"] == 0 and consumer["idle"] >= min_idle and consumer["name"] != self.consumer]
+        if consumers:
+            with self.redis.pipeline(transaction=False) as pipeline:
+                for consumer in consumers:
+                    pipeline.xgroup_delconsumer(self.name, self.group, consumer)
+                pipeline.execute()
+        return len(consumers)
+
+    def stats(self):
+        """
+        队列积压情况
+        length: stream中的消息数，pending: 已读取未ack的消息数，undelivered: 还未读取的消息数
+        lag: 最早一条消息等待的秒数
+        """
+        self.ensure_group()
+        length = self.redis.xlen(self.name)
+        pending = self.redis.xpending(self.name, self.group)["pending"]
+        first = self.redis.xrange(self.name, count=1)
+        lag = time.time() - int(first[0][0].split("-")[0]) / 1000 if first else 0
+        return {
+            "length": length,
+            "pending": pending,
+            "undelivered": length - pending,
+            "lag": lag
+        }
+
+
 class MyRedis(object):
-    def __init__(self, db, expire=None):
+    # 允许使用旧数据的散列表中，记录数据应当刷新的时间戳的字段
+    REFRESH_FIELD = "_refresh"
+
+    def __init__(self, db, expire=None, jitter=0.1, stale=None):
+        """
+        :param db:
+        :param expire: 键的保活时间
+        :param jitter: 保活时间随机增加的比例，避免同一时刻写入的键在同一秒过期
+        :param stale: 数据过了刷新时间后，还允许被当作旧数据使用的秒数，用于get_or_rebuild
+        """
         self.redis = redis.Redis(host=IPHOST, port=6379, decode_responses=True, db=db)
         self.expire = expire
+        self.jitter = jitter
+        self.stale = stale
+        # register_script只计算sha，第一次执行时才会把脚本加载到redis中
+        self.hincrby_if_exists_script = self.redis.register_script(HINCRBY_IF_EXISTS)
+        self.hincrby_existing_script = self.redis.register_script(HINCRBY_EXISTING)
+        self.toggle_appreciation_script = self.redis.register_script(TOGGLE_APPRECIATION)
+        self.release_lock_script = self.redis.register_script(RELEASE_LOCK)
+
+    def expire_time(self):
+        """
+        返回带随机抖动的保活时间
+        """
+        return self.expire + random.randint(0, int(self.expire * self.jitter))
+
+    def ttl_time(self):
+        """
+        返回键实际的保活时间，允许使用旧数据时要额外保留stale秒
+        """
+        return self.expire_time() + (self.stale or 0)
 
     def expire_key(self, name, permanent):
         if not permanent and self.expire:
-            self.redis.expire(name, self.expire)
+            self.redis.expire(name, self.ttl_time())
 
     def set(self, name, value, permanent=False):
         """
@@ -24,6 +329,125 @@ class MyRedis(object):
         self.expire_key(name, permanent)
         return res
 
+    def set_many(self, mapping, permanent=False):
+        """
+        用一次pipeline写入多个散列表
+        :param mapping: 键名到散列表内容的映射
+        :param permanent:
+        :return:
+        """
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for name, value in mapping.items():
+                if not permanent and self.expire:
+                    if self.stale:
+                        value = dict(value, **{self.REFRESH_FIELD: int(time.time()) + self.expire_time()})
+                    pipeline.hmset(name, value)
+                    pipeline.expire(name, self.ttl_time())
+                else:
+                    pipeline.hmset(name, value)
+            pipeline.execute()
+
+    def acquire_locks(self, *names, timeout=5):
+        """
+        用一次pipeline尝试为多个键加锁，返回加锁成功的键
+        锁在timeout秒后自动释放，防止持有锁的请求异常退出后锁无法释放
+        """
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for name in names:
+                pipeline.set("lock:{}".format(name), 1, nx=True, ex=timeout)
+            res = pipeline.execute()
+        return [name for name, locked in zip(names, res) if locked]
+
+    def release_locks(self, *names):
+        if names:
+            self.redis.delete(*["lock:{}".format(name) for name in names])
+
+    def acquire_lock(self, name, timeout=5):
+        """
+        加一把带令牌的锁，用于持有时间较长、可能超时的任务
+        :return: 加锁成功返回令牌，释放时交给release_lock核对，加锁失败返回None
+        """
+        token = os.urandom(16).hex()
+        return token if self.redis.set("lock:{}".format(name), token, nx=True, ex=timeout) else None
+
+    def release_lock(self, name, token):
+        """
+        只释放令牌一致的锁
+        :return: 释放成功返回1，锁已经超时或被其他进程持有时返回0
+        """
+        return self.release_lock_script(keys=["lock:{}".format(name)], args=[token])
+
+    def get_or_rebuild(self, items, rebuild, wait=0.2, interval=0.02):
+        """
+        批量读取散列表，缺失的数据由rebuild重建，同一个键同一时刻只有一个请求在重建
+        1.数据存在但过了刷新时间：抢到锁的请求把刷新时间与保活时间往后推，不从数据库重建
+          缓存中的计数包含还没有落库的增量，用数据库的计数覆盖会丢掉这些增量
+        2.数据不存在：抢到锁的请求负责重建，抢不到的等待至多wait秒，超时后再自己重建
+        :param items: 键名到对象的映射
+        :param rebuild: 接收对象列表，从数据库重建并写入缓存，返回键名到数据的映射
+        :return: 键名到数据的映射
+        """
+        names = list(items)
+        if not names:
+            return {}
+        res, missing, expired = {}, [], []
+        now = time.time()
+        for name, value in zip(names, self.get_many(*names)):
+            if not value:
+                missing.append(name)
+                continue
+            res[name] = value
+            if self.stale and int(value.get(self.REFRESH_FIELD, 0)) < now:
+                expired.append(name)
+
+        locked = self.acquire_locks(*(missing + expired)) if missing or expired else []
+        if locked:
+            try:
+                rebuilding = [name for name in locked if name not in res]
+                if rebuilding:
+                    res.update(rebuild([items[name] for name in rebuilding]))
+                self.push_refresh([name for name in locked if name in res and name not in rebuilding], res)
+            finally:
+                self.release_locks(*locked)
+
+        waiting = [name for name in missing if name not in res]
+        deadline = time.time() + wait
+        while waiting and time.time() < deadline:
+            time.sleep(interval)
+            for name, value in zip(waiting, self.get_many(*waiting)):
+                if value:
+                    res[name] = value
+            waiting = [name for name in waiting if name not in res]
+        if waiting:
+            res.update(rebuild([items[name] for name in waiting]))
+        return res
+
+    def push_refresh(self, names, values):
+        """
+        把过了刷新时间的散列表的刷新时间与保活时间往后推，散列表在此期间过期时不会被写入一个只有刷新时间的空壳
+        :param values: 键名到读取到的散列表的映射
+        """
+        if not names:
+            return
+        refresh = int(time.time()) + self.expire_time()
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for name in names:
+                amount = refresh - int(values[name].get(self.REFRESH_FIELD, 0))
+                self.hincrby_if_exists(name, self.REFRESH_FIELD, amount, client=pipeline)
+            pipeline.execute()
+
+    def stream(self, name="stream", group="flusher"):
+        """
+        返回一个基于stream与消费者组的持久化队列
+        """
+        return StreamQueue(self.redis, name, group)
+
+    def local(self, namespace, maxsize=1024, ttl=60):
+        """
+        为一个命名空间开启进程内缓存，失效通知通过当前redis连接广播
+        """
+        return LocalCache(self.redis, namespace, maxsize=maxsize, ttl=ttl)
+
     def set_pointed(self, name, key, value, permanent=False, json=False):
         """
         :param name:
@@ -46,6 +470,21 @@ class MyRedis(object):
                 res[key] = js.loads(value)
         return res
 
+    def get_many(self, *names, json=False):
+        """
+        用一次pipeline取出多个散列表，返回的列表与names一一对应，不存在的键对应空字典
+        :param names:
+        :param json:
+        :return:
+        """
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for name in names:
+                pipeline.hgetall(name)
+            res = pipeline.execute()
+        if json:
+            res = [{key: js.loads(value) for key, value in item.items()} for item in res]
+        return res
+
     def get_pointed(self, name, *args, json=False):
         res = self.redis.hmget(name=name, keys=args)
         if json:
@@ -67,6 +506,12 @@ class MyRedis(object):
         """
         return self.redis.hdel(name, *key)
 
+    def set_members(self, name):
+        """
+        返回集合中的全部元素，集合不存在时返回空集合
+        """
+        return self.redis.smembers(name)
+
     def list_push(self, name, *value, json=False):
         """
         往list中添加value
@@ -111,12 +556,134 @@ class MyRedis(object):
         self.expire_key(name, permanent)
         return res
 
+    def hincrby_if_exists(self, name, key, amount=1, permanent=False, client=None):
+        """
+        在一次原子操作中完成：判断散列表是否存在、增减字段、刷新保活时间
+        :param name:
+        :param key:
+        :param amount:
+        :param permanent:
+        :param client: 传入pipeline时脚本会随pipeline一起执行，结果在pipeline.execute()中返回
+        :return: 增加后的值，散列表不存在时返回None
+        """
+        args = [key, amount, 0 if permanent or not self.expire else self.ttl_time()]
+        return self.hincrby_if_exists_script(keys=[name], args=args, client=client)
+
+    def hincrby_existing(self, name, *keys, amount=1):
+        """
+        在一次原子操作中增减散列表中已经存在的字段，不存在的字段不会被创建
+        :return: 增减的字段数
+        """
+        if not keys:
+            return 0
+        return self.hincrby_existing_script(keys=[name], args=[amount, *keys])
+
+    def hll_add(self, name, *values, expire=None):
+        """
+        把values加入HyperLogLog，并刷新保活时间
+        :return: 1说明基数估计值发生了变化，即大概率出现了新的元素，否则为0
+        """
+        with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.pfadd(name, *values)
+            if expire:
+                pipeline.expire(name, expire)
+            res = pipeline.execute()
+        return res[0]
+
+    def hll_counts(self, *names):
+        """
+        用一次pipeline取出多个HyperLogLog的基数估计值，返回的列表与names一一对应
+        """
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for name in names:
+                pipeline.pfcount(name)
+            return pipeline.execute()
+
+    def toggle_appreciation(self, name, key, user_id, timestamp, queue="stream", force=False, sentinel="_"):
+        """
+        在一次原子操作中切换点赞状态、记入队列并刷新保活时间，同一用户连续点击也不会让状态错乱
+        :param name: 用户点赞集合的键名
+        :param key: 文章/评论id
+        :param force: 为True时即使用户点赞集合不存在也直接写入
+        :param sentinel: 集合中的占位元素，保证没有点过赞的用户也有一个非空集合
+        :return: 切换后的status，用户点赞集合不存在时返回None
+        """
+        args = [key, user_id, timestamp, self.expire_time(), 1 if force else 0, sentinel]
+        return self.toggle_appreciation_script(keys=[name, queue], args=args)
+
+    def hash_replace(self, name, mapping, chunk=1000, permanent=True):
+        """
+        用mapping整体替换一个散列表，先写入临时键再rename，读取方不会看到写了一半的散列表
+        """
+        if not mapping:
+            return self.redis.delete(name)
+        tmp_name = "{}:tmp".format(name)
+        items = list(mapping.items())
+        with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.delete(tmp_name)
+            for i in range(0, len(items), chunk):
+                pipeline.hmset(tmp_name, dict(items[i: i + chunk]))
+            pipeline.rename(tmp_name, name)
+            pipeline.execute()
+        self.expire_key(name, permanent)
+        return True
+
+    def zset_replace(self, name, mapping, chunk=1000):
+        """
+        用mapping整体替换一个有序集合，先写入临时键再rename，读取方不会看到写了一半的集合
+        :param name:
+        :param mapping: member到score的映射
+        :param chunk: 每条zadd命令写入的数量
+        :return:
+        """
+        if not mapping:
+            return self.redis.delete(name)
+        tmp_name = "{}:tmp".format(name)
+        items = list(mapping.items())
+        with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.delete(tmp_name)
+            for i in range(0, len(items), chunk):
+                pipeline.zadd(tmp_name, dict(items[i: i + chunk]))
+            pipeline.rename(tmp_name, name)
+            pipeline.execute()
+        return True
+
+    def zset_range(self, name, start, end, desc=True):
+        """
+        按排名返回有序集合中[start, end]之间的member，默认从高分到低分
+        """
+        if desc:
+            return self.redis.zrevrange(name, start, end)
+        return self.redis.zrange(name, start, end)
+
+    def zset_count(self, name):
+        """
+        返回有序集合中member的数量
+        """
+        return self.redis.zcard(name)
+
+    def zset_delete(self, name, *members):
+        """
+        从有序集合中删除member，返回删除的数量
+        """
+        return self.redis.zrem(name, *members)
+
     def exists(self, key):
         """
         判断某个键是否存在
         """
         return self.redis.exists(key)
 
+    def missing(self, *names):
+        """
+        用一次pipeline判断多个键是否存在，返回不存在的键
+        """
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for name in names:
+                pipeline.exists(name)
+            res = pipeline.execute()
+        return [name for name, exist in zip(names, res) if not exist]
+
     def hexists(self, name, key):
         """
         判断hash是否有某个键
@@ -131,9 +698,15 @@ class MyRedis(object):
 
 
 front_cache = MyRedis(db=0, expire=86400 * 30)
-article_cache = MyRedis(db=1, expire=3600)
+article_cache = MyRedis(db=1, expire=3600, stale=600)
 like_cache = MyRedis(db=2, expire=3600)
-comment_cache = MyRedis(db=3, expire=3600)
+comment_cache = MyRedis(db=3, expire=3600, stale=600)
 rate_cache = MyRedis(db=4, expire=3600)
 notify_cache = MyRedis(db=5, expire=3600)
+counter_cache = MyRedis(db=6)
+feed_cache = MyRedis(db=7, expire=60)
 cms_cache = MyRedis(db=15, expire=86400)
+
+board_local = front_cache.local("boards", maxsize=256, ttl=300)
+author_local = front_cache.local("authors", maxsize=4096, ttl=60)
+tag_local = article_cache.local("article_tags", maxsize=4096, ttl=300)
@@ -0,0 +1,185 @@
+from .cache import counter_cache
+from .models import Article, Comment, SubComment
+from front.models import Notification
+from exts import db
+from contextlib import contextmanager
+from sqlalchemy import func
+import time
+
+
+class Counter(object):
+    """
+    维护某一类筛选条件下的数据总数，用来替代列表接口里每次都要执行的COUNT(*)
+    每个计数器对应缓存中的一个散列表，散列表的键由筛选条件拼接而成，例如articles散列表中的"1:3:0"
+    列表接口读取总数为O(1)，写入路径负责增减，reconcile_counters定时任务负责对账修正
+    每个键最近一次被读取的时间记录在{name}:read有序集合中，长时间没有被读取的键在对账时删除
+    """
+
+    def __init__(self, name, column, query_factory, converters=(str,), group_by=None, filters=(), idle=86400 * 7):
+        """
+        :param name: 缓存中散列表的名字
+        :param column: 统计时COUNT的列
+        :param query_factory: 接收筛选条件，返回对应的query
+        :param converters: 从缓存键还原筛选条件时，每个条件对应的类型
+        :param group_by: 只有一个筛选条件时，筛选条件对应的列，对账时用IN加GROUP BY一次统计一批键
+        :param filters: 配合group_by使用，除筛选条件以外的其他过滤条件
+        :param idle: 超过idle秒没有被读取的键会在对账时删除
+        """
+        self.name = name
+        self.read_name = "{}:read".format(name)
+        self.column = column
+        self.query_factory = query_factory
+        self.converters = converters
+        self.group_by = group_by
+        self.filters = filters
+        self.idle = idle
+
+    @staticmethod
+    def field(*args):
+        return ":".join(str(arg) for arg in args)
+
+    def parse(self, field):
+        return [converter(arg) for converter, arg in zip(self.converters, field.split(":"))]
+
+    def count(self, *args):
+        """
+        直接从数据库中统计数量
+        """
+        return self.query_factory(*args).with_entities(func.count(self.column)).scalar()
+
+    def rebuild(self, *args):
+        count = self.count(*args)
+        counter_cache.set_pointed(self.name, self.field(*args), count, permanent=True)
+        return count
+
+    def get(self, *args):
+        """
+        读取筛选条件对应的总数，缓存中没有时从数据库统计并写入缓存
+        """
+        field = self.field(*args)
+        with counter_cache.redis.pipeline(transaction=False) as pipeline:
+            pipeline.hget(self.name, field)
+            pipeline.zadd(self.read_name, {field: int(time.time())})
+            value, _ = pipeline.execute()
+        if value is None:
+            return self.rebuild(*args)
+        return int(value)
+
+    def increase(self, *conditions, amount=1):
+        """
+        conditions中每一项都是一组筛选条件
+        只增减缓存中已经存在的键，不存在的键等到下次读取时再从数据库统计，避免凭空生成一个只有增量的值
+        """
+        fields = [self.field(*condition) for condition in conditions]
+        counter_cache.hincrby_existing(self.name, *fields, amount=amount)
+
+    def shift(self, old_conditions, new_conditions):
+        """
+        数据从一组筛选条件移动到另一组筛选条件，例如文章被删除或者被设为精品
+        """
+        old_conditions, new_conditions = set(old_conditions), set(new_conditions)
+        self.increase(*(old_conditions - new_conditions), amount=-1)
+        self.increase(*(new_conditions - old_conditions), amount=1)
+
+    def count_many(self, fields):
+        """
+        统计一批键的数量，设置了group_by时只需要一条GROUP BY查询
+        """
+        if self.group_by is None:
+            return {field: self.count(*self.parse(field)) for field in fields}
+        keys = [self.parse(field)[0] for field in fields]
+        counts = {self.field(key): count for key, count in
+                  db.session.query(self.group_by, func.count(self.column))
+                  .filter(self.group_by.in_(keys), *self.filters).group_by(self.group_by)}
+        return {field: counts.get(field, 0) for field in fields}
+
+    def reconcile(self, chunk=1000):
+        """
+        对账：先删除超过idle秒没有被读取的键，再分批重新统计剩下的键，修正写入路径上可能产生的偏差
+        被删除的键不会再被写入路径增减，下次读取时从数据库重新统计
+        :return: 修正的键数量
+        """
+        expired = counter_cache.redis.zrangebyscore(self.read_name, 0, int(time.time()) - self.idle)
+        for i in range(0, len(expired), chunk):
+            with counter_cache.redis.pipeline(transaction=False) as pipeline:
+                pipeline.hdel(self.name, *expired[i: i + chunk])
+                pipeline.zrem(self.read_name, *expired[i: i + chunk])
+                pipeline.execute()
+
+        count = 0
+        fields = []
+        for field, _ in counter_cache.redis.hscan_iter(self.name, count=chunk):
+            fields.append(field)
+            if len(fields) >= chunk:
+                count += self.reconcile_fields(fields)
+                fields = []
+        if fields:
+            count += self.reconcile_fields(fields)
+        return count
+
+    def reconcile_fields(self, fields):
+        values = self.count_many(fields)
+        now = int(time.time())
+        with counter_cache.redis.pipeline(transaction=False) as pipeline:
+            pipeline.hmset(self.name, values)
+            # 没有读取记录的键从现在开始计算闲置时间
+            pipeline.zadd(self.read_name, {field: now for field in fields}, nx=True)
+            pipeline.execute()
+        return len(values)
+
+
+def _article_query(status, board_id, quality):
+    articles = Article.query.filter_by(status=status)
+    if board_id:
+        articles = articles.filter_by(board_id=board_id)
+    if quality:
+        articles = articles.filter_by(quality=1)
+    return articles
+
+
+# 文章数，筛选条件为(status, board_id, quality)，board_id为0时不区分板块，quality为0时不区分精品
+article_counter = Counter("articles", Article.id, _article_query, converters=(int, int, int))
+# 用户发表的文章数，筛选条件为(author_id, )
+post_counter = Counter("posts", Article.id, lambda author_id: Article.query.filter_by(author_id=author_id, status=1),
+                       group_by=Article.author_id, filters=(Article.status == 1, ))
+# 文章下的评论数，筛选条件为(article_id, )
+comment_counter = Counter("comments", Comment.id,
+                          lambda article_id: Comment.query.filter_by(article_id=article_id, status=1),
+                          group_by=Comment.article_id, filters=(Comment.status == 1, ))
+# 评论下的楼中楼数，筛选条件为(comment_id, )
+sub_comment_counter = Counter("sub_comments", SubComment.id,
+                              lambda comment_id: SubComment.query.filter_by(comment_id=comment_id, status=1),
+                              group_by=SubComment.comment_id, filters=(SubComment.status == 1, ))
+# 用户收到的消息数，筛选条件为(acceptor_id, )
+notify_counter = Counter("notifications", Notification.id,
+                         lambda acceptor_id: Notification.query.filter_by(acceptor_id=acceptor_id),
+                         group_by=Notification.acceptor_id)
+
+COUNTERS = [article_counter, post_counter, comment_counter, sub_comment_counter, notify_counter]
+
+
+def article_conditions(article):
+    """
+    返回文章在当前状态下被计入的所有article_counter筛选条件
+    """
+    if article.status is None:
+        return []
+    conditions = [(article.status, 0, 0), (article.status, article.board_id, 0)]
+    if article.quality:
+        conditions += [(article.status, 0, 1), (article.status, article.board_id, 1)]
+    return conditions
+
+
+@contextmanager
+def track_article(article):
+    """
+    在with块中新建文章或修改文章的status/quality，退出时根据前后差异更新文章相关的计数器
+    with track_article(article):
+        article.status = 0
+        db.session.commit()
+    """
+    old_conditions, old_status = article_conditions(article), article.status
+    yield article
+    article_counter.shift(old_conditions, article_conditions(article))
+    if bool(old_status) != bool(article.status):
+        post_counter.increase((article.author_id, ), amount=1 if article.status else -1)
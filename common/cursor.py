@@ -0,0 +1,35 @@
+from .exceptions import ArgumentsError
+from datetime import datetime
+import base64
+import json
+
+
+CURSOR_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def encode_cursor(created, item_id):
+    """
+    将(created, id)编码成对前端不透明的游标字符串
+    :param created: 最后一条数据的创建时间
+    :param item_id: 最后一条数据的id
+    :return:
+    """
+    raw = json.dumps([created.strftime(CURSOR_TIME_FORMAT), item_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    将游标字符串解码为(created, id)，游标不合法时抛出ArgumentsError
+    :param cursor:
+    :return:
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created, item_id = json.loads(raw)
+        created = datetime.strptime(created, CURSOR_TIME_FORMAT)
+    except (ValueError, TypeError, UnicodeError):
+        raise ArgumentsError("游标格式错误")
+    if not isinstance(item_id, str):
+        raise ArgumentsError("游标格式错误")
+    return created, item_id
@@ -0,0 +1,48 @@
+from .cache import feed_cache
+import json
+
+
+# 每个板块当前的列表版本号，文章新增、删除或精品状态变化时加一，旧版本的缓存不会再被读取，等待自然过期
+FEED_GENERATIONS = "feed_generations"
+
+
+def feed_generation(board_id):
+    """
+    读取板块当前的列表版本号，请求在查询数据库之前取出，写入缓存时使用同一个版本号
+    查询期间列表失效时，写入的是已经作废的版本，不会把删除的文章放回第一页
+    """
+    return int(feed_cache.redis.hget(FEED_GENERATIONS, board_id) or 0)
+
+
+def feed_name(mode, board_id, quality, limit, generation):
+    """
+    每个列表的第一页单独存放在一个键中，各自过期，互不影响保活时间
+    """
+    return "feed:{}:{}:{}:{}:{}".format(board_id, generation, mode, quality, limit)
+
+
+def get_feed(mode, board_id, quality, limit, generation):
+    """
+    获取缓存中某个文章列表的第一页，不存在时返回None
+    缓存的是所有用户共享的数据，liked字段需要调用方按当前用户重新填充
+    """
+    data = feed_cache.redis.get(feed_name(mode, board_id, quality, limit, generation))
+    return json.loads(data) if data else None
+
+
+def set_feed(mode, board_id, quality, limit, generation, data):
+    feed_cache.redis.set(feed_name(mode, board_id, quality, limit, generation), json.dumps(data),
+                         ex=feed_cache.expire_time())
+
+
+def invalidate_feed(*board_ids):
+    """
+    文章新增、删除或精品状态变化时，全站以及对应板块的列表版本号加一，作废这些板块的第一页缓存
+    :return: 作废的板块数量
+    """
+    board_ids = {0, *board_ids}
+    with feed_cache.redis.pipeline(transaction=False) as pipeline:
+        for board_id in board_ids:
+            pipeline.hincrby(FEED_GENERATIONS, board_id, 1)
+        pipeline.execute()
+    return len(board_ids)
@@ -2,11 +2,15 @@ from exts import db
 from datetime import datetime
 from flask import g
 from sqlalchemy import func
-from front.models import Like, Rate
+from sqlalchemy.orm.attributes import set_committed_value
+from front.models import Like, Rate, FrontUser
+from .ranking import hot_rank
+from .cache import article_cache, board_local, tag_local
+from .aggregator import Aggregator
+from config import UNIQUE_VIEWS, VIEWS_SHARDS, VIEW_AGGREGATOR
 from jieba.analyse.analyzer import ChineseAnalyzer
 import shortuuid
-import json
-import math
+import zlib
 
 
 article_tag_table = db.Table("article_tag_table",
@@ -25,15 +29,47 @@ class Board(db.Model):
 
     articles = db.relationship("Article", backref="board", lazy="dynamic")
 
+    def card(self):
+        return {
+            "board_id": self.id,
+            "name": self.name,
+            "desc": self.desc,
+            "avatar": self.avatar,
+            "status": self.status
+        }
+
+    @staticmethod
+    def get_cards(*board_ids):
+        """
+        从进程内缓存中批量取出板块数据，返回以板块id为键的字典，不存在的板块不会出现在结果中
+        """
+        return board_local.get_many(board_ids, lambda missing: {
+            board.id: board.card() for board in Board.query.filter(Board.id.in_(missing))})
+
+    @staticmethod
+    def get_visible_cards():
+        """
+        从进程内缓存中取出所有可见的板块
+        """
+        return board_local.get("visible", lambda: [board.card() for board in Board.query.filter_by(status=1)])
+
 
 class Article(db.Model):
     __tablename__ = "articles"
     __searchable__ = ["title", "content"]
     __analyzer__ = ChineseAnalyzer()
+    # 文章列表按(created, id)倒序做游标分页，以下联合索引覆盖了全站/板块/精品三种筛选
+    __table_args__ = (
+        db.Index("ix_articles_status_created", "status", "created", "id"),
+        db.Index("ix_articles_board_status_created", "board_id", "status", "created", "id"),
+        db.Index("ix_articles_quality_status_created", "quality", "status", "created", "id"),
+    )
 
     id = db.Column(db.String(50), primary_key=True, default=shortuuid.uuid)
     title = db.Column(db.String(20), nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    # 正文默认不随列表查询加载，列表只返回摘要，访问content时才会单独查询正文
+    content = db.deferred(db.Column(db.Text, nullable=False))
+    excerpt = db.Column(db.String(150))
     images = db.Column(db.Text, default="")
     created = db.Column(db.DateTime, default=datetime.now)
     status = db.Column(db.Integer, default=1)
@@ -47,58 +83,223 @@ class Article(db.Model):
     likes = db.relationship("Like", backref="article", lazy="dynamic")
     tags = db.relationship("Tag", secondary=article_tag_table, backref=db.backref("articles"))
 
+    excerpt_length = 100
+    # 写入数据库之后才增减缓存的字段
+    committed_fields = ("comments", )
+
     def add_tags(self, *tags):
         for tag in tags:
             self.tags.append(tag)
 
+    @staticmethod
+    def make_excerpt(content):
+        return (content or "")[:Article.excerpt_length]
+
+    def get_excerpt(self):
+        """
+        返回文章摘要，旧数据没有摘要时退化为从正文截取
+        """
+        if self.excerpt is None:
+            return Article.make_excerpt(self.content)
+        return self.excerpt
+
+    @property
+    def image_list(self):
+        return self.images.split(",") if self.images else []
+
     def is_liked(self, user_likes=None):
         """
         如果被用户喜欢，返回True，否则返回False
         """
-        if user_likes:
-            value = user_likes.get(self.id)
-            if not value:
-                return False
-            if isinstance(value, str):
-                value = json.loads(value)
-            return value["status"] == 1
+        if user_likes is not None:
+            return Article.in_likes(self.id, user_likes)
         like = self.likes.filter_by(user_id=g.user.id).first()
         return like is not None
 
+    @staticmethod
+    def in_likes(article_id, user_likes):
+        """
+        根据get_all_appreciation取出的用户点赞集合判断文章是否被喜欢
+        """
+        return article_id in user_likes
+
     def set_property_cache(self, cache):
-        views = self.views
-        likes = self.likes.filter_by(status=1).with_entities(func.count(Like.id)).scalar()
-        comments = self.comments.filter_by(status=1).with_entities(func.count(Comment.id)).scalar()
-        res = dict(likes=likes, comments=comments, views=views)
-        cache.set(self.id, res)
-        return res
+        return Article.set_property_caches(cache, [self])[self.id]
 
     def get_property_cache(self, cache):
-        pro = cache.get(self.id)
-        if not pro:
-            pro = self.set_property_cache(cache)
-        return pro
+        return Article.get_property_caches(cache, [self])[self.id]
 
-    def cache_increase(self, cache, field, amount=1):
-        if not cache.exists(self.id):
+    @staticmethod
+    def set_property_caches(cache, articles):
+        """
+        从数据库重建一组文章的属性缓存，点赞数与评论数各用一条GROUP BY查询，结果用一次pipeline写回
+        返回以文章id为键的字典
+        """
+        article_ids = [article.id for article in articles]
+        likes = dict(db.session.query(Like.article_id, func.count(Like.id))
+                     .filter(Like.article_id.in_(article_ids), Like.status == 1)
+                     .group_by(Like.article_id))
+        comments = dict(db.session.query(Comment.article_id, func.count(Comment.id))
+                        .filter(Comment.article_id.in_(article_ids), Comment.status == 1)
+                        .group_by(Comment.article_id))
+        res = {article.id: dict(likes=likes.get(article.id, 0),
+                                comments=comments.get(article.id, 0),
+                                views=article.views) for article in articles}
+        if UNIQUE_VIEWS["enabled"]:
+            unique_views = cache.hll_counts(*[Article.uv_name(article_id) for article_id in article_ids])
+            for article_id, count in zip(article_ids, unique_views):
+                res[article_id]["unique_views"] = count
+        cache.set_many(res)
+        return res
+
+    @staticmethod
+    def get_property_caches(cache, articles):
+        """
+        用一次pipeline取出一组文章的属性缓存，未命中的文章统一从数据库重建，过了刷新时间的只延长保活时间
+        热门文章的缓存过期时只有一个请求会去重建，其他请求等待重建完成
+        返回以文章id为键的字典
+        """
+        return cache.get_or_rebuild({article.id: article for article in articles},
+                                    lambda missing: Article.set_property_caches(cache, missing))
+
+    @staticmethod
+    def load_relations(articles):
+        """
+        批量加载一组文章的板块、作者与标签，每种关系只查询一次
+        查询结果直接写入orm对象，之后访问article.board等属性不会再触发懒加载
+        """
+        articles = list(articles)
+        if not articles:
+            return articles
+
+        article_ids = [article.id for article in articles]
+        board_ids = {article.board_id for article in articles}
+        author_ids = {article.author_id for article in articles}
+
+        boards = {board.id: board for board in Board.query.filter(Board.id.in_(board_ids))}
+        authors = {user.id: user for user in FrontUser.query.filter(FrontUser.id.in_(author_ids))}
+        tags = {article_id: [] for article_id in article_ids}
+        rows = db.session.query(article_tag_table.c.article_id, Tag)\
+            .join(Tag, Tag.id == article_tag_table.c.tag_id)\
+            .filter(article_tag_table.c.article_id.in_(article_ids))
+        for article_id, tag in rows:
+            tags[article_id].append(tag)
+
+        for article in articles:
+            set_committed_value(article, "board", boards.get(article.board_id))
+            set_committed_value(article, "author", authors.get(article.author_id))
+            set_committed_value(article, "tags", tags[article.id])
+        return articles
+
+    @staticmethod
+    def get_tag_cards(*article_ids):
+        """
+        从进程内缓存中批量取出文章的标签，返回以文章id为键的字典，没有标签的文章对应空列表
+        """
+        def load(missing):
+            tags = {article_id: [] for article_id in missing}
+            rows = db.session.query(article_tag_table.c.article_id, Tag.id, Tag.content)\
+                .join(Tag, Tag.id == article_tag_table.c.tag_id)\
+                .filter(article_tag_table.c.article_id.in_(missing))
+            for article_id, tag_id, content in rows:
+                tags[article_id].append({"tag_id": tag_id, "content": content})
+            return tags
+        return tag_local.get_many(article_ids, load)
+
+    def cache_increase(self, cache, field, amount=1, rank=True):
+        """
+        缓存命中时一次往返完成增减，未命中时从数据库重建
+        committed_fields中的字段是在写数据库之后才增减的，重建的结果已经包含了这次变化，不能再加一次
+        :param rank: 是否同时更新实时热榜
+        """
+        with cache.redis.pipeline(transaction=False) as pipeline:
+            cache.hincrby_if_exists(self.id, field, amount, client=pipeline)
+            # 等待落库的浏览量增量与属性缓存不在同一个slot，单独一条命令，不论属性缓存是否存在都要记录
+            if field == "views":
+                pipeline.hincrby(Article.views_name(self.id), self.id, amount)
+            res = pipeline.execute()[0]
+        if res is None:
             self.set_property_cache(cache)
-        cache.hincrby(self.id, field, amount)
-        if field == "views":
-            cache.hincrby("views", self.id)
+            if field not in self.committed_fields:
+                cache.hincrby_if_exists(self.id, field, amount)
+        if rank:
+            hot_rank.bump(self.id, field, amount)
 
-    def calculate_score(self, date):
+    @staticmethod
+    def views_name(article_id):
         """
-        计算文章的score
-        :param date:
-        :return:
+        等待落库的浏览量增量按文章id的crc32分散到VIEWS_SHARDS个散列表中，避免所有浏览都写同一个热点键
+        分片编号放在{}中作为hash tag，分片与它的快照在redis集群中落在同一个slot，可以直接rename
         """
-        td = date - self.created
-        epoch_hours = td.days * 24 + td.seconds / 3600 + 1     # 文章发布的小时数
-        views = self.views
-        comments = self.comments.filter_by(status=1).with_entities(func.count(Comment.id)).scalar()
-        likes = self.likes.filter_by(status=1).with_entities(func.count(Like.id)).scalar()
-        numerator = math.log(views + 1, math.e) * 4 + (comments + likes) / 5
-        return round((numerator / epoch_hours) * 100, 7)
+        return "views:{{{}}}".format(zlib.crc32(article_id.encode()) % VIEWS_SHARDS)
+
+    @staticmethod
+    def views_names():
+        return ["views:{{{}}}".format(i) for i in range(VIEWS_SHARDS)]
+
+    @staticmethod
+    def uv_name(article_id):
+        return "uv:{}".format(article_id)
+
+    def add_view(self, cache, user_id):
+        """
+        记录一次浏览，开启独立访客统计时把用户加入文章的HyperLogLog，新访客才增加unique_views
+        热榜用独立访客数排行时，同一用户重复打开文章不再增加热度
+        开启浏览量聚合时只记入进程内的缓冲区，由flush_views批量写入
+        """
+        if VIEW_AGGREGATOR["enabled"]:
+            return view_aggregator.add(self.id, user_id if UNIQUE_VIEWS["enabled"] else None)
+        if not UNIQUE_VIEWS["enabled"]:
+            return self.cache_increase(cache, "views")
+        unique = cache.hll_add(Article.uv_name(self.id), user_id, expire=UNIQUE_VIEWS["expire"])
+        # 属性缓存不存在时不增加，下面重建属性缓存时会直接统计HyperLogLog
+        if unique:
+            cache.hincrby_if_exists(self.id, "unique_views", 1)
+        self.cache_increase(cache, "views", rank=unique or not UNIQUE_VIEWS["rank"])
+
+    @staticmethod
+    def flush_views(cache, views, viewers):
+        """
+        把聚合器中累计的浏览一次性写入redis，每一步都是一次pipeline
+        属性缓存不存在的文章只记录等待落库的增量，不在后台线程中访问数据库重建
+        :param views: 文章id到浏览次数的映射
+        :param viewers: 文章id到浏览用户集合的映射
+        """
+        article_ids = list(views)
+        unique = dict.fromkeys(article_ids, 0)
+        if viewers:
+            # 前后两次PFCOUNT之差就是这批浏览中新增的独立访客数
+            # 多个进程同时写入时，用事务保证两次PFCOUNT之间没有其他进程的PFADD，同一个新访客只被统计一次
+            with cache.redis.pipeline(transaction=True) as pipeline:
+                for article_id, users in viewers.items():
+                    name = Article.uv_name(article_id)
+                    pipeline.pfcount(name)
+                    pipeline.pfadd(name, *users)
+                    pipeline.expire(name, UNIQUE_VIEWS["expire"])
+                    pipeline.pfcount(name)
+                res = pipeline.execute()
+            for i, article_id in enumerate(viewers):
+                unique[article_id] = res[4 * i + 3] - res[4 * i]
+
+        with cache.redis.pipeline(transaction=False) as pipeline:
+            for article_id in article_ids:
+                cache.hincrby_if_exists(article_id, "views", views[article_id], client=pipeline)
+                pipeline.hincrby(Article.views_name(article_id), article_id, views[article_id])
+                if unique[article_id]:
+                    cache.hincrby_if_exists(article_id, "unique_views", unique[article_id], client=pipeline)
+            pipeline.execute()
+
+        hot_rank.bump_many("views", unique if UNIQUE_VIEWS["enabled"] and UNIQUE_VIEWS["rank"] else views)
+
+
+class ViewSnapshot(db.Model):
+    """
+    已经落库的浏览量快照，与浏览量在同一个事务中写入
+    快照落库后从redis删除失败时，下次执行会跳过这里记录过的快照，浏览量不会重复累加
+    """
+    __tablename__ = "view_snapshots"
+    name = db.Column(db.String(100), primary_key=True)
+    created = db.Column(db.DateTime, default=datetime.now)
 
 
 class Comment(db.Model):
@@ -115,37 +316,57 @@ class Comment(db.Model):
     sub_comments = db.relationship("SubComment", backref="comment", lazy="dynamic")
     rates = db.relationship("Rate", backref="comment", lazy="dynamic")
 
+    # 写入数据库之后才增减缓存的字段
+    committed_fields = ("sub_comments", )
+
     def is_rated(self, user_rates=None):
         """
         如果被用户点赞了，返回True和rate_id，否则返回False和None
         """
-        if user_rates:
-            value = user_rates.get(self.id)
-            if not value:
-                return False
-            if isinstance(value, str):
-                value = json.loads(value)
-            return value["status"] == 1
+        if user_rates is not None:
+            return self.id in user_rates
         rate = self.rates.filter_by(user_id=g.user.id).first()
         return rate is not None
 
     def set_property_cache(self, cache):
-        rates = self.rates.filter_by(status=1).with_entities(func.count(Rate.id)).scalar()
-        sub_comments = self.sub_comments.filter_by(status=1).with_entities(func.count(SubComment.id)).scalar()
-        res = dict(rates=rates, sub_comments=sub_comments)
-        cache.set(self.id, res)
-        return res
+        return Comment.set_property_caches(cache, [self])[self.id]
 
     def get_property_cache(self, cache):
-        pro = cache.get(self.id)
-        if not pro:
-            pro = self.set_property_cache(cache)
-        return pro
+        return Comment.get_property_caches(cache, [self])[self.id]
+
+    @staticmethod
+    def set_property_caches(cache, comments):
+        """
+        从数据库重建一组评论的属性缓存，点赞数与楼中楼数各用一条GROUP BY查询，结果用一次pipeline写回
+        返回以评论id为键的字典
+        """
+        comment_ids = [comment.id for comment in comments]
+        rates = dict(db.session.query(Rate.comment_id, func.count(Rate.id))
+                     .filter(Rate.comment_id.in_(comment_ids), Rate.status == 1)
+                     .group_by(Rate.comment_id))
+        sub_comments = dict(db.session.query(SubComment.comment_id, func.count(SubComment.id))
+                            .filter(SubComment.comment_id.in_(comment_ids), SubComment.status == 1)
+                            .group_by(SubComment.comment_id))
+        res = {comment.id: dict(rates=rates.get(comment.id, 0),
+                                sub_comments=sub_comments.get(comment.id, 0)) for comment in comments}
+        cache.set_many(res)
+        return res
+
+    @staticmethod
+    def get_property_caches(cache, comments):
+        """
+        用一次pipeline取出一组评论的属性缓存，未命中的评论统一从数据库重建，重建过程防击穿
+        过了刷新时间的评论只延长保活时间，缓存中还没有落库的点赞数不会被数据库的计数覆盖
+        返回以评论id为键的字典
+        """
+        return cache.get_or_rebuild({comment.id: comment for comment in comments},
+                                    lambda missing: Comment.set_property_caches(cache, missing))
 
     def cache_increase(self, cache, field, amount=1):
-        if not cache.exists(self.id):
+        if cache.hincrby_if_exists(self.id, field, amount) is None:
             self.set_property_cache(cache)
-        cache.hincrby(self.id, field, amount)
+            if field not in self.committed_fields:
+                cache.hincrby_if_exists(self.id, field, amount)
 
 
 class SubComment(db.Model):
@@ -191,3 +412,8 @@ class Tag(db.Model):
                 db.session.add(tag)
             res.append(tag)
         return res
+
+
+view_aggregator = Aggregator(lambda views, viewers: Article.flush_views(article_cache, views, viewers),
+                             interval=VIEW_AGGREGATOR["interval"], max_size=VIEW_AGGREGATOR["max_size"],
+                             max_retry_size=VIEW_AGGREGATOR["max_retry_size"])
@@ -0,0 +1,299 @@
+from .cache import article_cache
+from config import HOT_SCORE
+from datetime import timedelta
+import numpy as np
+
+
+class Candidates(object):
+    """
+    候选文章的列式数据，每一列都是等长的numpy数组，方便一次性向量化计算全部分数
+    """
+
+    def __init__(self, ids, views, likes, comments, created, boards=None, qualities=None):
+        """
+        :param ids: 文章id
+        :param views: 浏览数
+        :param likes: 点赞数
+        :param comments: 评论数
+        :param created: 发表时间的时间戳（秒）
+        :param boards: 所属板块id
+        :param qualities: 是否精品
+        """
+        self.ids = np.asarray(ids, dtype=object)
+        self.views = np.asarray(views, dtype=np.float64)
+        self.likes = np.asarray(likes, dtype=np.float64)
+        self.comments = np.asarray(comments, dtype=np.float64)
+        self.created = np.asarray(created, dtype=np.float64)
+        size = len(self.ids)
+        self.boards = np.zeros(size, dtype=np.int64) if boards is None else np.asarray(boards, dtype=np.int64)
+        self.qualities = np.zeros(size, dtype=np.int64) if qualities is None else np.asarray(qualities, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def from_rows(articles, likes, comments):
+        """
+        :param articles: (id, views, created, board_id, quality)组成的查询结果
+        :param likes: 文章id到点赞数的映射
+        :param comments: 文章id到评论数的映射
+        :return:
+        """
+        size = len(articles)
+        ids = np.empty(size, dtype=object)
+        views = np.empty(size, dtype=np.float64)
+        created = np.empty(size, dtype=np.float64)
+        boards = np.empty(size, dtype=np.int64)
+        qualities = np.empty(size, dtype=np.int64)
+        like_counts = np.empty(size, dtype=np.float64)
+        comment_counts = np.empty(size, dtype=np.float64)
+        for i, (article_id, view, created_at, board_id, quality) in enumerate(articles):
+            ids[i] = article_id
+            views[i] = view or 0
+            created[i] = created_at.timestamp()
+            boards[i] = board_id or 0
+            qualities[i] = 1 if quality else 0
+            like_counts[i] = likes.get(article_id, 0)
+            comment_counts[i] = comments.get(article_id, 0)
+        return Candidates(ids, views, like_counts, comment_counts, created, boards, qualities)
+
+    @staticmethod
+    def random(size, now, days=100, boards=8, seed=None):
+        """
+        生成随机的候选文章，用于离线压测打分引擎
+        """
+        rng = np.random.RandomState(seed)
+        ids = np.array(["bench{}".format(i) for i in range(size)], dtype=object)
+        views = rng.poisson(200, size)
+        likes = rng.poisson(10, size)
+        comments = rng.poisson(5, size)
+        start = (now - timedelta(days=days)).timestamp()
+        created = rng.uniform(start, now.timestamp(), size)
+        board_ids = rng.randint(1, boards + 1, size)
+        qualities = (rng.uniform(0, 1, size) < 0.05).astype(np.int64)
+        return Candidates(ids, views, likes, comments, created, board_ids, qualities)
+
+
+class ScoreEngine(object):
+    """
+    热度打分引擎
+    score = log(1 + engagement) + (created - epoch) / tau
+    engagement = views * view_weight + likes * like_weight + comments * comment_weight
+    发表时间越晚基础分越高，每晚tau秒发表的文章只需要1/e的互动量就能与之前的文章持平
+    分数与当前时间无关，新的浏览、点赞、评论只需要累加engagement就能增量地更新分数
+    """
+
+    def __init__(self, view_weight=1, like_weight=5, comment_weight=10, epoch=1577808000, tau=45000):
+        self.weights = {
+            "views": view_weight,
+            "likes": like_weight,
+            "comments": comment_weight
+        }
+        self.epoch = epoch
+        self.tau = tau
+
+    @staticmethod
+    def from_config():
+        return ScoreEngine(**HOT_SCORE)
+
+    def engagement(self, views, likes, comments):
+        return views * self.weights["views"] + likes * self.weights["likes"] + comments * self.weights["comments"]
+
+    def base(self, created):
+        """
+        :param created: 发表时间的时间戳（秒），可以是数组
+        """
+        return (created - self.epoch) / self.tau
+
+    @staticmethod
+    def combine(engagement, base):
+        return np.log1p(np.maximum(engagement, 0)) + base
+
+    def score(self, candidates):
+        """
+        一次性计算所有候选文章的分数，返回与candidates等长的数组
+        """
+        engagement = self.engagement(candidates.views, candidates.likes, candidates.comments)
+        return self.combine(engagement, self.base(candidates.created))
+
+    def rank(self, candidates, k=None):
+        """
+        计算分数并取出前k名，k为None时返回全部文章
+        :return: 按分数从高到低排列的(ids, scores)
+        """
+        scores = self.score(candidates)
+        if k is None or k >= len(scores):
+            index = np.argsort(-scores, kind="stable")
+        else:
+            # argpartition只做O(n)的划分，只有前k名需要真正排序
+            index = np.argpartition(-scores, k)[:k]
+            index = index[np.argsort(-scores[index], kind="stable")]
+        return candidates.ids[index], scores[index]
+
+
+class HotRank(object):
+    """
+    实时热榜，数据都存放在article_cache中
+    rank:{board_id}:{quality}: 文章id到分数的有序集合，board_id为0时为全站热榜，quality为1时只包含精品
+    hot:base: 文章id到基础分(created - epoch) / tau的散列表，只有在热榜窗口内的文章才有
+    hot:engagement: 文章id到互动量的散列表
+    hot:meta: 文章id到"board_id:quality"的散列表，用来确定一篇文章属于哪几个热榜
+    定时任务用数据库中的准确数据重新校准(rebase)，两次校准之间由浏览、点赞、评论事件增量更新
+    热榜分页结果在进程内缓存几秒，热榜成员变化时通知所有进程丢弃，互动量变化只依靠过期刷新
+    """
+    RANK = "rank"
+    BASE = "hot:base"
+    ENGAGEMENT = "hot:engagement"
+    META = "hot:meta"
+
+    def __init__(self, cache, engine):
+        self.cache = cache
+        self.engine = engine
+        self.local = cache.local("hot_rank", maxsize=512, ttl=5)
+
+    def rank_key(self, board_id=0, quality=0):
+        return "{}:{}:{}".format(self.RANK, board_id, 1 if quality else 0)
+
+    def rank_keys(self, board_id, quality):
+        """
+        返回一篇文章所属的全部热榜
+        """
+        keys = [self.rank_key(), self.rank_key(board_id)]
+        if quality:
+            keys += [self.rank_key(quality=1), self.rank_key(board_id, quality=1)]
+        return keys
+
+    def parse_meta(self, meta):
+        board_id, quality = meta.split(":")
+        return int(board_id), int(quality)
+
+    def add(self, article):
+        """
+        新发表的文章以零互动量进入热榜
+        """
+        base = float(self.engine.base(article.created.timestamp()))
+        quality = 1 if article.quality else 0
+        with self.cache.redis.pipeline(transaction=False) as pipeline:
+            pipeline.hset(self.BASE, article.id, base)
+            pipeline.hset(self.ENGAGEMENT, article.id, 0)
+            pipeline.hset(self.META, article.id, "{}:{}".format(article.board_id, quality))
+            for key in self.rank_keys(article.board_id, quality):
+                pipeline.zadd(key, {article.id: base})
+            pipeline.execute()
+        self.local.invalidate()
+
+    def bump(self, article_id, field, amount=1):
+        """
+        文章发生了浏览、点赞或评论，累加互动量并更新它所属的全部热榜
+        :param field: views, likes或comments
+        """
+        self.bump_many(field, {article_id: amount})
+
+    def bump_many(self, field, amounts):
+        """
+        一次更新多篇文章的同一种互动量，共两次往返
+        :param amounts: 文章id到增量的映射
+        """
+        weight = self.engine.weights.get(field)
+        article_ids = [article_id for article_id, amount in amounts.items() if amount]
+        if not weight or not article_ids:
+            return
+        with self.cache.redis.pipeline(transaction=False) as pipeline:
+            pipeline.hmget(self.BASE, article_ids)
+            pipeline.hmget(self.META, article_ids)
+            for article_id in article_ids:
+                pipeline.hincrbyfloat(self.ENGAGEMENT, article_id, weight * amounts[article_id])
+            bases, metas, *engagements = pipeline.execute()
+            for article_id, base, meta, engagement in zip(article_ids, bases, metas, engagements):
+                # 不在热榜窗口内的文章不参与实时排行，多出来的互动量会在下次校准时被整体覆盖
+                if base is None or meta is None:
+                    continue
+                score = float(self.engine.combine(float(engagement), float(base)))
+                for key in self.rank_keys(*self.parse_meta(meta)):
+                    pipeline.zadd(key, {article_id: score})
+            pipeline.execute()
+
+    def set_quality(self, article):
+        """
+        文章被设为精品或取消精品后，同步精品热榜
+        """
+        meta = self.cache.get_pointed(self.META, article.id)[0]
+        if meta is None:
+            return
+        board_id, _ = self.parse_meta(meta)
+        quality_keys = [self.rank_key(quality=1), self.rank_key(board_id, quality=1)]
+        with self.cache.redis.pipeline(transaction=False) as pipeline:
+            pipeline.hset(self.META, article.id, "{}:{}".format(board_id, 1 if article.quality else 0))
+            if article.quality:
+                score = self.cache.redis.zscore(self.rank_key(), article.id) or 0
+                for key in quality_keys:
+                    pipeline.zadd(key, {article.id: score})
+            else:
+                for key in quality_keys:
+                    pipeline.zrem(key, article.id)
+            pipeline.execute()
+        self.local.invalidate()
+
+    def remove(self, *article_ids):
+        if not article_ids:
+            return
+        metas = self.cache.get_pointed(self.META, *article_ids)
+        with self.cache.redis.pipeline(transaction=False) as pipeline:
+            pipeline.zrem(self.rank_key(), *article_ids)
+            for article_id, meta in zip(article_ids, metas):
+                if meta is not None:
+                    for key in self.rank_keys(*self.parse_meta(meta)):
+                        pipeline.zrem(key, article_id)
+            pipeline.hdel(self.BASE, *article_ids)
+            pipeline.hdel(self.ENGAGEMENT, *article_ids)
+            pipeline.hdel(self.META, *article_ids)
+            pipeline.execute()
+        self.local.invalidate()
+
+    def rebase(self, candidates):
+        """
+        用数据库中统计出的准确数据，在同一次打分中整体重建全站、各板块以及精品热榜
+        :return: 文章id到分数的映射
+        """
+        engagement = self.engine.engagement(candidates.views, candidates.likes, candidates.comments)
+        base = self.engine.base(candidates.created)
+        scores = self.engine.combine(engagement, base)
+        ids = candidates.ids.tolist()
+        metas = ["{}:{}".format(board_id, quality)
+                 for board_id, quality in zip(candidates.boards.tolist(), candidates.qualities.tolist())]
+        self.cache.hash_replace(self.ENGAGEMENT, dict(zip(ids, engagement.tolist())))
+        self.cache.hash_replace(self.BASE, dict(zip(ids, base.tolist())))
+        self.cache.hash_replace(self.META, dict(zip(ids, metas)))
+
+        # 用布尔掩码从全部分数中切出每个板块与精品的热榜
+        ranks = {self.rank_key(): np.ones(len(candidates), dtype=bool)}
+        quality = candidates.qualities == 1
+        ranks[self.rank_key(quality=1)] = quality
+        for board_id in np.unique(candidates.boards).tolist():
+            board = candidates.boards == board_id
+            ranks[self.rank_key(board_id)] = board
+            ranks[self.rank_key(board_id, quality=1)] = board & quality
+
+        for key, mask in ranks.items():
+            self.cache.zset_replace(key, dict(zip(candidates.ids[mask].tolist(), scores[mask].tolist())))
+        # 已经没有候选文章的板块热榜直接删除
+        for key in self.cache.redis.scan_iter("{}:*".format(self.RANK)):
+            if key not in ranks and not key.endswith(":tmp"):
+                self.cache.delete(key)
+        self.local.invalidate()
+        return dict(zip(ids, scores.tolist()))
+
+    def page(self, offset, limit, board_id=0, quality=0):
+        """
+        按排名返回一页文章id
+        """
+        key = self.rank_key(board_id, quality)
+        return self.local.get("{}:{}:{}".format(key, offset, limit),
+                              lambda: self.cache.zset_range(key, offset, offset + limit - 1))
+
+    def count(self, board_id=0, quality=0):
+        key = self.rank_key(board_id, quality)
+        return self.local.get(key, lambda: self.cache.zset_count(key))
+
+
+hot_rank = HotRank(article_cache, ScoreEngine.from_config())
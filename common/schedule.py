@@ -1,13 +1,19 @@
 from .cache import like_cache, article_cache, rate_cache, comment_cache, notify_cache
-from .models import Article, Comment
+from .models import Article, Comment, ViewSnapshot
+from .counter import COUNTERS, notify_counter
+from .ranking import Candidates, hot_rank
+from config import HOT_WINDOW_DAYS, WARM_CACHE, UNIQUE_VIEWS
 from front.models import FrontUser, Rate, Like, Notification
 from common.exceptions import *
 from exts import db, scheduler
+from sqlalchemy import func, case
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.exc import SQLAlchemyError
 from functools import wraps
 from datetime import datetime, timedelta
 import json
+import shortuuid
 import time
-import heapq
 
 
 class logger():
@@ -33,102 +39,427 @@ class logger():
         return inner
 
 
+class phase():
+    """
+    统计任务中某一阶段的耗时与处理的数据量
+    with phase("查询候选文章") as p:
+        rows = query.all()
+        p.rows = len(rows)
+    """
+    def __init__(self, info):
+        self.info = info
+        self.rows = 0
+
+    def __enter__(self):
+        self.t1 = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        t2 = time.time()
+        print("【{}】耗时【{:.3f}】s...共【{}】条数据...".format(self.info, t2 - self.t1, self.rows))
+
+    def advance(self, rows, total=None):
+        """
+        分批处理时汇报进度与吞吐量
+        """
+        self.rows += rows
+        elapsed = time.time() - self.t1
+        print("【{}】进度【{}/{}】...速度【{:.0f}】条/s...".format(
+            self.info, self.rows, total if total is not None else "?", self.rows / elapsed if elapsed else 0))
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i: i + size]
+
+
+# 正在落库的浏览量快照，落库成功后才删除，失败的快照在下次执行时重试
+# 快照名为"分片名:snapshot:时间戳"，与分片共用hash tag，分片之前遗留的views散列表的快照为"{views}:snapshot:时间戳"
+VIEWS_SNAPSHOT = ":snapshot:"
+# 等待落库的快照名称集合，与rename在同一个pipeline中写入，落库时读取它而不是扫描整个库
+VIEWS_SNAPSHOTS = "views_snapshots"
+# 改用集合记录快照之前遗留的快照只需要扫描一次，扫描完成后写入这个键
+VIEWS_SNAPSHOTS_SCANNED = "views_snapshots_scanned"
+# 同一时刻只允许一个进程保存浏览量，超时时间要远大于一次落库的耗时
+VIEWS_LOCK = "save_views"
+VIEWS_LOCK_TIMEOUT = 600
+# 已落库快照的记录保留天数，之后快照早已从redis删除，不会再被重试
+VIEWS_SNAPSHOT_KEEP_DAYS = 7
+
+
+def save_views_snapshots(snapshots, chunk=500):
+    """
+    用一次pipeline取出一组浏览量快照并按文章合并，再用UPDATE ... CASE分批写入数据库
+    所有批次与快照名称的记录在同一个事务中提交，提交成功后删除全部快照，提交失败时保留快照
+    已经记录过的快照是上次落库后没能删除的，跳过不再累加
+    :return: 更新的文章数量
+    """
+    applied = {name for name, in db.session.query(ViewSnapshot.name).filter(ViewSnapshot.name.in_(snapshots))}
+    pending = [snapshot for snapshot in snapshots if snapshot not in applied]
+    views, recorded = {}, []
+    for name, snapshot in zip(pending, article_cache.get_many(*pending)):
+        # 没有浏览的分片rename失败，集合中留下的名称没有对应的快照，不需要记录
+        if snapshot:
+            recorded.append(name)
+        for article_id, view in snapshot.items():
+            views[article_id] = views.get(article_id, 0) + int(view)
+    views = list(views.items())
+    table = Article.__table__
+    count = 0
+    try:
+        for part in chunked(views, chunk):
+            ids = [article_id for article_id, _ in part]
+            res = db.session.execute(table.update()
+                                     .where(table.c.id.in_(ids))
+                                     .values(views=table.c.views + case(dict(part), value=table.c.id, else_=0)))
+            count += res.rowcount
+        now = datetime.now()
+        if recorded:
+            db.session.execute(ViewSnapshot.__table__.insert(), [{"name": name, "created": now} for name in recorded])
+        db.session.query(ViewSnapshot).filter(ViewSnapshot.created < now - timedelta(days=VIEWS_SNAPSHOT_KEEP_DAYS))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    # 快照分布在不同的slot，逐个删除
+    with article_cache.redis.pipeline(transaction=False) as pipeline:
+        for snapshot in snapshots:
+            pipeline.delete(snapshot)
+        pipeline.srem(VIEWS_SNAPSHOTS, *snapshots)
+        pipeline.execute()
+    return count
+
+
 @logger(info="保存文章浏览量数据")
 def save_views():
+    """
+    每个gunicorn进程都会在同一时刻执行这个任务，只有拿到锁的进程落库
+    否则一个进程正在提交的快照会被另一个进程当成失败遗留的快照再加一次
+    """
+    token = article_cache.acquire_lock(VIEWS_LOCK, timeout=VIEWS_LOCK_TIMEOUT)
+    if not token:
+        print("其他进程正在保存浏览量，跳过本次执行")
+        return 0
+    try:
+        return flush_views()
+    finally:
+        article_cache.release_lock(VIEWS_LOCK, token)
+
+
+def flush_views():
+    """
+    用rename把每个浏览量分片原子地换成快照，rename之后的浏览会写入新的分片，不会丢失
+    之前落库失败的快照与本次的快照合并后一起落库，调用方需要持有VIEWS_LOCK
+    """
+    client = article_cache.redis
+    if not client.exists(VIEWS_SNAPSHOTS_SCANNED):
+        legacy = list(client.scan_iter("*views*{}*".format(VIEWS_SNAPSHOT)))
+        if legacy:
+            client.sadd(VIEWS_SNAPSHOTS, *legacy)
+        client.set(VIEWS_SNAPSHOTS_SCANNED, 1)
+
+    stamp = int(time.time() * 1000)
+    # 最后的views是分片之前遗留的散列表
+    names = Article.views_names() + ["views"]
+    renamed = ["{}{}{}".format(name if name != "views" else "{views}", VIEWS_SNAPSHOT, stamp) for name in names]
+    with client.pipeline(transaction=False) as pipeline:
+        # 快照名称在rename之前写入集合，rename成功的快照一定能在集合中找到
+        # 这段时间内没有浏览的分片不存在，rename会返回错误，集合中对应的名称在落库后一起删除
+        pipeline.sadd(VIEWS_SNAPSHOTS, *renamed)
+        for name, snapshot in zip(names, renamed):
+            pipeline.rename(name, snapshot)
+        pipeline.execute(raise_on_error=False)
+    snapshots = list(client.smembers(VIEWS_SNAPSHOTS))
+    if not snapshots:
+        return 0
+
+    try:
+        return save_views_snapshots(snapshots)
+    except SQLAlchemyError as e:
+        print("浏览量快照落库失败，下次重试...{}".format(e))
+        return 0
+
+
+def save_appreciations(queue, model, target, foreign_key, category, sender_content, acceptor_content, chunk=1000):
+    """
+    把点赞队列分批写入数据库，每批只用IN查询预取已有的赞、被赞的文章/评论与用户，再用一条upsert批量写入
+    同一批中同一个用户对同一篇文章/评论的多次变化以时间最晚的一次为准
+    (用户, 文章/评论)上有唯一索引，已有的赞只在消息比最后一次变化更新时才改变状态，重放的旧消息不会覆盖新状态
+    没有见过的取消点赞也写入一行状态为0的赞，之后重放的旧点赞消息同样不会覆盖它
+    多个消费者可以同时落库，第一次点赞的通知带有唯一的去重键，重复的通知会被忽略
+    :param queue: 消息键到json数据的映射，json数据中的id为文章/评论id
+    :param model: Like或Rate
+    :param target: Article或Comment
+    :param foreign_key: model中指向target的列名
+    :param category: 通知类型
+    :param sender_content: 通知中发送者的内容
+    :param acceptor_content: target中作为通知接收者内容的列
+    :return: 写入的赞数量
+    """
+    items = {}
+    for value in queue.values():
+        value = json.loads(value)
+        key = (value["user_id"], value["id"])
+        if key not in items or value["created"] >= items[key]["created"]:
+            items[key] = value
+    items = list(items.items())
+    table = model.__table__
+    target_column = getattr(model, foreign_key)
+    # 只有消息比这一行最后一次变化更新时才改变状态，MySQL按顺序赋值，status必须在updated之前
+    last_changed = func.coalesce(table.c.updated, table.c.created)
+    upsert = insert(table)
+    upsert = upsert.on_duplicate_key_update([
+        ("status", case([(upsert.inserted.updated > last_changed, upsert.inserted.status)], else_=table.c.status)),
+        ("updated", func.greatest(last_changed, upsert.inserted.updated)),
+    ])
+    insert_notifications = Notification.__table__.insert().prefix_with("IGNORE")
     count = 0
-    views = article_cache.get("views")
-    article_cache.delete("views")
-    for article_id, view in views.items():
-        article = Article.query.get(article_id)
-        if article:
-            article.views += int(view)
-            count += 1
-    db.session.commit()
+    for part in chunked(items, chunk):
+        user_ids = {user_id for (user_id, _), _ in part}
+        target_ids = {target_id for (_, target_id), _ in part}
+        existing = set(db.session.query(model.user_id, target_column)
+                       .filter(model.user_id.in_(user_ids), target_column.in_(target_ids)))
+
+        # 被赞的文章/评论与用户都必须存在
+        targets = {row[0]: row for row in db.session.query(target.id, target.author_id, acceptor_content)
+                   .filter(target.id.in_(target_ids))}
+        users = {user_id for user_id, in db.session.query(FrontUser.id).filter(FrontUser.id.in_(user_ids))}
+
+        rows, notifications = [], []
+        now = datetime.now()
+        for key, value in part:
+            user_id, target_id = key
+            if target_id not in targets or user_id not in users:
+                continue
+            created = datetime.fromtimestamp(value["created"])
+            rows.append({"id": shortuuid.uuid(), "status": value["status"], "created": created, "updated": created,
+                         "user_id": user_id, foreign_key: target_id})
+            # 只有第一次点赞才发通知
+            _, author_id, content = targets[target_id]
+            if key not in existing and value["status"] and user_id != author_id:
+                notifications.append({"id": shortuuid.uuid(), "category": category, "link_id": target_id,
+                                      "sender_content": sender_content, "acceptor_content": content,
+                                      "visited": 0, "status": 1, "created": now,
+                                      "sender_id": user_id, "acceptor_id": author_id,
+                                      "unique_key": "{}:{}:{}".format(category, user_id, target_id)})
+        if rows:
+            db.session.execute(upsert, rows)
+        acceptors = {}
+        if notifications:
+            db.session.execute(insert_notifications, notifications)
+            # 去重键冲突被忽略的通知不会以本次生成的id出现在表中，只为真正插入的通知增加未读数
+            for acceptor_id, amount in db.session.query(Notification.acceptor_id, func.count(Notification.id))\
+                    .filter(Notification.id.in_([item["id"] for item in notifications]))\
+                    .group_by(Notification.acceptor_id):
+                acceptors[acceptor_id] = amount
+        db.session.commit()
+        count += len(rows)
+
+        # 提交之后再更新未读通知数，缓存不存在的用户下次读取时会从数据库统计
+        with notify_cache.redis.pipeline(transaction=False) as pipeline:
+            for acceptor_id, amount in acceptors.items():
+                notify_cache.hincrby_if_exists(acceptor_id, "new", amount, client=pipeline)
+            pipeline.execute()
+        for acceptor_id, amount in acceptors.items():
+            notify_counter.increase((acceptor_id, ), amount=amount)
     return count
 
 
-@logger(info="保存文章点赞数据")
-def save_likes():
-    queue = like_cache.get("queue")
-    like_cache.delete("queue")
+def remove_duplicate_appreciations(model, foreign_key, chunk=500):
+    """
+    清理同一个用户对同一篇文章/评论的重复赞，建立(用户, 文章/评论)唯一索引之前执行
+    旧的落库逻辑每次点赞都会插入新行，创建时间最晚的一行是最后一次点赞，保留这一行，删除其余的行
+    :param model: Like或Rate
+    :param foreign_key: model中指向文章/评论的列名
+    :param chunk: 每批处理的(用户, 文章/评论)数量
+    :return: 删除的行数
+    """
+    target_column = getattr(model, foreign_key)
+    pairs = db.session.query(model.user_id, target_column).group_by(model.user_id, target_column)\
+        .having(func.count(model.id) > 1).all()
     count = 0
-    for like_id, value in queue.items():
-        value = json.loads(value)
-        like = Like.query.get(like_id)
-        if like:
-            like.status = value["status"]
-            count += 1
-        elif value["status"]:
-            article_id, user_id, created = value["id"], value["user_id"], datetime.fromtimestamp(value["created"])
-            article = Article.query.get(article_id)
-            if article:
-                user = FrontUser.query.get(user_id)
-                if user:
-                    like = Like(created=created)
-                    like.user = user
-                    like.article = article
-
-                    if user.id != article.author_id:
-                        notification = Notification(category=1, link_id=article_id,
-                                                    sender_content="赞了你的帖子", acceptor_content=article.title)
-                        notification.acceptor = article.author
-                        notification.sender = user
-                        db.session.add(notification)
-                        article.author.notification_increase(notify_cache)
-
-                    db.session.add(like)
-                    count += 1
-    db.session.commit()
+    for part in chunked(pairs, chunk):
+        user_ids = {user_id for user_id, _ in part}
+        target_ids = {target_id for _, target_id in part}
+        wanted = set(part)
+        rows = {}
+        for item_id, user_id, target_id, created in db.session.query(model.id, model.user_id, target_column,
+                                                                      model.created)\
+                .filter(model.user_id.in_(user_ids), target_column.in_(target_ids)):
+            if (user_id, target_id) in wanted:
+                rows.setdefault((user_id, target_id), []).append((created or datetime.min, item_id))
+        delete_ids = [item_id for items in rows.values() for _, item_id in sorted(items)[:-1]]
+        if delete_ids:
+            db.session.query(model).filter(model.id.in_(delete_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        count += len(delete_ids)
     return count
 
 
+def consume_appreciations(cache, save, count=1000, min_idle=60000):
+    """
+    从点赞stream中分批读取消息交给save落库，落库成功后才ack，落库失败的消息留在stream中
+    每个gunicorn进程都是一个消费者，save与消息顺序无关，多个消费者可以同时落库
+    先认领其他消费者超过min_idle毫秒仍未ack的消息，再读取新消息，重放时由save按消息时间丢弃已经过时的变化
+    :param save: 接收赞id到json数据的映射并落库
+    :return: 落库的赞数量
+    """
+    total = 0
+    # 迁移到stream之前遗留的队列散列表，没有新数据写入，直接落库后删除
+    legacy = cache.get("queue")
+    if legacy:
+        total += save(legacy)
+        cache.delete("queue")
+
+    queue = cache.stream()
+    queue.ensure_group()
+    queue.prune()
+    print("点赞队列共【{length}】条...已读取未确认【{pending}】条...未读取【{undelivered}】条...最早的消息已等待【{lag:.1f}】s"
+          .format(**queue.stats()))
+
+    entries = queue.claim(min_idle=min_idle, count=count)
+    while True:
+        if not entries:
+            entries = queue.read(count=count)
+        if not entries:
+            break
+        # stream是有序的，同一个赞的多次变化以最后一次为准
+        try:
+            total += save({fields["item_id"]: fields["value"] for _, fields in entries})
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print("点赞落库失败，消息保留在队列中等待重试...{}".format(e))
+            break
+        queue.ack(*[entry_id for entry_id, _ in entries])
+        entries = None
+    return total
+
+
+@logger(info="保存文章点赞数据")
+def save_likes():
+    return consume_appreciations(like_cache, lambda queue: save_appreciations(
+        queue, Like, Article, "article_id", category=1, sender_content="赞了你的帖子", acceptor_content=Article.title))
+
+
 @logger(info="保存评论点赞数据")
 def save_rates():
-    queue = rate_cache.get("queue")
-    rate_cache.delete("queue")
-    count = 0
-    for rate_id, value in queue.items():
-        value = json.loads(value)
-        rate = Rate.query.get(rate_id)
-        if rate:
-            rate.status = value["status"]
-            count += 1
-        elif value["status"]:
-            comment_id, user_id, created = value["id"], value["user_id"], datetime.fromtimestamp(value["created"])
-            comment = Comment.query.get(comment_id)
-            if comment:
-                user = FrontUser.query.get(user_id)
-                if user:
-                    rate = Rate(created=created)
-                    rate.user = user
-                    rate.comment = comment
-
-                    if user.id != comment.author_id:
-                        notification = Notification(category=2, link_id=comment_id,
-                                                    sender_content="赞了你的评论", acceptor_content=comment.content)
-                        notification.acceptor = comment.author
-                        notification.sender = user
-                        db.session.add(notification)
-                        comment.author.notification_increase(notify_cache)
-
-                    db.session.add(rate)
-                    count += 1
-    db.session.commit()
-    return count
+    return consume_appreciations(rate_cache, lambda queue: save_appreciations(
+        queue, Rate, Comment, "comment_id", category=2, sender_content="赞了你的评论", acceptor_content=Comment.content))
 
 
 @logger(info="计算热帖排行")
 def calculator_article_score():
-    # 暂时定十五天内的帖子
     now = datetime.now()
-    t1 = time.time()
-    articles = Article.query.filter(Article.created >= now - timedelta(days=100), Article.status == 1).all()
-    score = {article.id: article.calculate_score(now) for article in articles}
-    t2 = time.time()
-    print("搜索数据库耗时: {:.3f}".format(t2 - t1))
-    t1 = time.time()
-    hot_articles = heapq.nlargest(10, score, key=lambda item: score[item])
-    t2 = time.time()
-    print("堆排序耗时: {:.3f}".format(t2 - t1))
-    article_cache.set_pointed("hot", "rank", hot_articles, json=True, permanent=True)
+    candidates = (Article.created >= now - timedelta(days=HOT_WINDOW_DAYS), Article.status == 1)
+
+    # 候选文章只取计算需要的列，点赞数与评论数各用一条GROUP BY查询统计，不再逐篇COUNT
+    with phase("查询候选文章") as p:
+        articles = db.session.query(Article.id, Article.views, Article.created, Article.board_id, Article.quality)\
+            .filter(*candidates).all()
+        p.rows = len(articles)
+
+    with phase("统计点赞数") as p:
+        likes = dict(db.session.query(Like.article_id, func.count(Like.id))
+                     .join(Article, Article.id == Like.article_id)
+                     .filter(Like.status == 1, *candidates)
+                     .group_by(Like.article_id).all())
+        p.rows = len(likes)
+
+    with phase("统计评论数") as p:
+        comments = dict(db.session.query(Comment.article_id, func.count(Comment.id))
+                        .join(Article, Article.id == Comment.article_id)
+                        .filter(Comment.status == 1, *candidates)
+                        .group_by(Comment.article_id).all())
+        p.rows = len(comments)
+
+    # 用独立访客数代替浏览量参与排行，同一用户反复打开文章不会刷高热度
+    if UNIQUE_VIEWS["enabled"] and UNIQUE_VIEWS["rank"]:
+        with phase("统计独立访客数") as p:
+            unique_views = []
+            for part in chunked(articles, 1000):
+                unique_views += article_cache.hll_counts(*[Article.uv_name(row[0]) for row in part])
+            articles = [(row[0], count) + tuple(row[2:]) for row, count in zip(articles, unique_views)]
+            p.rows = len(articles)
+
+    # 整理成列式数组后一次性向量化打分，并校准实时热榜，两次校准之间热榜由互动事件增量更新
+    with phase("校准热榜") as p:
+        candidates = Candidates.from_rows(articles, likes, comments)
+        score = hot_rank.rebase(candidates)
+        p.rows = len(score)
     return len(score)
+
+
+@logger(info="计数器对账")
+def reconcile_counters():
+    count = 0
+    for counter in COUNTERS:
+        count += counter.reconcile()
+    return count
+
+
+def warm_caches(articles=2000, users=2000, days=7, chunk=500):
+    """
+    预热缓存，只写入缓存中还不存在的键，已经存在的键可能含有尚未落库的增量，不能用数据库中的数据覆盖
+    1.最新的articles篇文章与热榜前articles篇文章的属性缓存，以及它们下面评论的属性缓存
+    2.最近days天内点过赞、评论或发过帖的至多users个用户的点赞缓存与未读通知数
+    :return: 写入的缓存数量
+    """
+    count = 0
+    since = datetime.now() - timedelta(days=days)
+
+    with phase("收集预热文章") as p:
+        recent = [article_id for article_id, in db.session.query(Article.id).filter(Article.status == 1)
+                  .order_by(Article.created.desc()).limit(articles)]
+        # 热榜在前，去重后保持顺序，先预热最热的文章
+        article_ids = list(dict.fromkeys(hot_rank.page(0, articles) + recent))
+        p.rows = len(article_ids)
+
+    with phase("预热文章属性缓存") as p:
+        missing = article_cache.missing(*article_ids) if article_ids else []
+        for ids in chunked(missing, chunk):
+            items = Article.query.filter(Article.id.in_(ids), Article.status == 1).all()
+            if items:
+                Article.set_property_caches(article_cache, items)
+            p.advance(len(items), len(missing))
+        count += p.rows
+
+    with phase("预热评论属性缓存") as p:
+        for ids in chunked(article_ids, chunk):
+            comment_ids = [comment_id for comment_id, in db.session.query(Comment.id)
+                           .filter(Comment.article_id.in_(ids), Comment.status == 1)]
+            for comment_ids in chunked(comment_cache.missing(*comment_ids) if comment_ids else [], chunk):
+                items = Comment.query.filter(Comment.id.in_(comment_ids)).all()
+                Comment.set_property_caches(comment_cache, items)
+                p.advance(len(items))
+        count += p.rows
+
+    with phase("收集活跃用户") as p:
+        user_ids = set()
+        for column, created in ((Like.user_id, Like.created), (Rate.user_id, Rate.created),
+                                (Comment.author_id, Comment.created), (Article.author_id, Article.created)):
+            user_ids.update(user_id for user_id, in db.session.query(column).filter(created >= since)
+                            .distinct().limit(users))
+        user_ids = list(user_ids)[:users]
+        p.rows = len(user_ids)
+
+    appreciations = {FrontUser.appreciation_name(user_id): user_id for user_id in user_ids}
+    for info, cache, names, rebuild in (
+            ("预热用户文章点赞缓存", like_cache, appreciations,
+             lambda ids: FrontUser.set_appreciations(like_cache, "likes", ids)),
+            ("预热用户评论点赞缓存", rate_cache, appreciations,
+             lambda ids: FrontUser.set_appreciations(rate_cache, "rates", ids)),
+            ("预热用户未读通知数", notify_cache, {user_id: user_id for user_id in user_ids},
+             lambda ids: FrontUser.set_new_notifications_counts(notify_cache, ids))):
+        with phase(info) as p:
+            missing = [names[name] for name in cache.missing(*names)] if names else []
+            for ids in chunked(missing, chunk):
+                rebuild(ids)
+                p.advance(len(ids), len(missing))
+            count += p.rows
+    return count
+
+
+@logger(info="缓存预热")
+def warm_cache():
+    return warm_caches(**WARM_CACHE)
@@ -0,0 +1,111 @@
+from flask import make_response
+from flask_restful import fields
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _formatter(field, namespace):
+    """
+    为单个flask_restful字段生成格式化函数，放入namespace中并返回它在namespace中的名字
+    格式化规则与flask_restful.marshal保持一致：值为None时返回字段的默认值
+    """
+    if isinstance(field, dict):
+        field = fields.Nested(field)
+    elif isinstance(field, type):
+        field = field()
+
+    if isinstance(field, fields.Nested):
+        nested = _compile(field.nested, namespace)
+        if field.allow_null:
+            def format_value(value, nested=nested):
+                return None if value is None else nested(value)
+        else:
+            format_value = nested
+    elif isinstance(field, fields.List):
+        item = namespace[_formatter(field.container, namespace)]
+
+        def format_value(value, item=item, default=field.default):
+            if value is None:
+                return default
+            return [item(v) for v in value]
+    elif isinstance(field, (fields.Integer, fields.String, fields.Boolean, fields.Float)):
+        cast = {fields.Integer: int, fields.String: str, fields.Boolean: bool, fields.Float: float}[type(field)]
+
+        def format_value(value, cast=cast, default=field.default):
+            return default if value is None else cast(value)
+    else:
+        def format_value(value, field=field):
+            return field.output("value", {"value": value})
+
+    name = "_format_{}".format(len(namespace))
+    namespace[name] = format_value
+    return name
+
+
+def _compile(resource_fields, namespace):
+    """
+    将一层字段定义编译成一个直接构造dict的函数，每个字段只做一次取值和一次格式化
+    """
+    lines = ["def serialize(obj):",
+             "    if obj is None:",
+             "        obj = {}",
+             "    return {"]
+    for key, field in resource_fields.items():
+        source = getattr(field, "attribute", None) or key
+        lines.append("        {!r}: {}(obj.get({!r})),".format(key, _formatter(field, namespace), source))
+    lines.append("    }")
+    local = {}
+    exec("\n".join(lines), namespace, local)
+    return local["serialize"]
+
+
+def compile_fields(resource_fields):
+    """
+    将flask_restful风格的resource_fields编译成序列化函数
+    函数接收由dict组成的数据，返回只包含普通dict与list的结果，可以直接交给json编码
+    """
+    return _compile(resource_fields, {})
+
+
+class Serializer(object):
+    """
+    编译后的响应序列化器，替代marshal_with与Data对象
+    返回的数据结构与common.restful中的code/message/data格式一致
+    """
+
+    def __init__(self, resource_fields):
+        self.serialize = compile_fields(resource_fields)
+
+    def raw_resp(self, code, message, data):
+        return self.serialize({"code": code, "message": message, "data": data})
+
+    def success(self, data):
+        return self.raw_resp(code=200, message="OK", data=data)
+
+
+def envelope(data, code=200, message="OK"):
+    """
+    包装已经序列化好的数据
+    """
+    return {"code": code, "message": message, "data": data}
+
+
+def dumps(data):
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def output_json(data, code, headers=None):
+    """
+    flask_restful的json表示函数，优先使用orjson编码
+    用法：api.representations["application/json"] = output_json
+    """
+    resp = make_response(dumps(data), code)
+    resp.headers.extend(headers or {})
+    resp.headers["Content-Type"] = "application/json"
+    return resp
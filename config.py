@@ -13,6 +13,47 @@ SECRET_KEY = b')\xf6\x7f\xb3\x82iC\xce\xc5\x18\x84\xf2\xab\x12V\x9e\x80\xabKg\xa
 IMAGE_ICON = "?imageView2/1/w/64/h/64/q/75"
 IMAGE_PIC = "?imageView2/0/q/75"
 
+# 热度打分参数，含义见common.ranking.ScoreEngine
+HOT_SCORE = {
+    "view_weight": 1,
+    "like_weight": 5,
+    "comment_weight": 10,
+    "epoch": 1577808000,    # 2020-01-01 00:00:00
+    "tau": 45000
+}
+# 参与热度排行的文章发表天数
+HOT_WINDOW_DAYS = 100
+
+# 浏览量增量分散存放的散列表数量，见common.models.Article.views_name
+VIEWS_SHARDS = 16
+
+# 独立访客统计，enabled为True时用HyperLogLog记录每篇文章的浏览用户，每篇文章至多占用12KB
+# rank为True时热度排行用独立访客数代替浏览量，同一用户重复打开文章不再增加热度
+UNIQUE_VIEWS = {
+    "enabled": True,
+    "rank": False,
+    "expire": 86400 * HOT_WINDOW_DAYS
+}
+
+# 浏览量写后聚合，enabled为True时每个进程在内存中累计浏览量，每interval秒一次性写入redis
+# 缓冲区中的文章与访客总数达到max_size时立即写入，redis写入失败时至多在缓冲区中保留max_retry_size条等待重试
+VIEW_AGGREGATOR = {
+    "enabled": True,
+    "interval": 1,
+    "max_size": 10000,
+    "max_retry_size": 40000
+}
+
+# 缓存预热参数，含义见common.schedule.warm_caches，部署后也可以手动执行python manage.py warm_cache
+WARM_CACHE = {
+    "articles": 2000,
+    "users": 2000,
+    "days": 7,
+    "chunk": 500
+}
+# 为True时定时预热缓存
+WARM_CACHE_ENABLED = False
+
 SCHEDULER_API_ENABLED = True
 JOBS = [
     {
@@ -33,10 +74,24 @@ JOBS = [
         "trigger": "cron",
         "minute": "10,25,40,55"
     },
+    {
+        "id": "reconcile_counters",
+        "func": "common.schedule:reconcile_counters",
+        "trigger": "cron",
+        "minute": "7"
+    },
     {
         "id": "calculate_score",
         "func": "common.schedule:calculator_article_score",
         "trigger": "cron",
-        "hour": "4,16"
+        "hour": "4"
     }
 ]
+
+if WARM_CACHE_ENABLED:
+    JOBS.append({
+        "id": "warm_cache",
+        "func": "common.schedule:warm_cache",
+        "trigger": "cron",
+        "minute": "3"
+    })
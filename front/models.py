@@ -1,17 +1,26 @@
 from exts import db, mail
 from flask_mail import Message
 from cms.models import Permission
+from common.ranking import hot_rank
+from common.cache import author_local
 from datetime import datetime
 from sqlalchemy import func
+from sqlalchemy.dialects.mysql import DATETIME
 import shortuuid
-import json
 
 
 class Like(db.Model):
     __tablename__ = "likes"
+    # 点赞落库时按(用户, 文章)查找已有的赞，同一个用户对同一篇文章只有一个赞
+    # 执行数据库迁移建立唯一索引之前，先执行python manage.py dedup_appreciations清理历史遗留的重复赞
+    __table_args__ = (
+        db.Index("ix_likes_user_article", "user_id", "article_id", unique=True),
+    )
     id = db.Column(db.String(50), primary_key=True, default=shortuuid.uuid)
     status = db.Column(db.Integer, default=1)
     created = db.Column(db.DateTime, default=datetime.now)
+    # 最后一次状态变化的时间，精确到毫秒，落库时只接受比它更新的变化，为空时以created为准
+    updated = db.Column(DATETIME(fsp=3))
 
     article_id = db.Column(db.String(50), db.ForeignKey("articles.id"))
     user_id = db.Column(db.String(50), db.ForeignKey("front_user.id"))
@@ -19,9 +28,16 @@ class Like(db.Model):
 
 class Rate(db.Model):
     __tablename__ = "rates"
+    # 点赞落库时按(用户, 评论)查找已有的赞，同一个用户对同一条评论只有一个赞
+    # 执行数据库迁移建立唯一索引之前，先执行python manage.py dedup_appreciations清理历史遗留的重复赞
+    __table_args__ = (
+        db.Index("ix_rates_user_comment", "user_id", "comment_id", unique=True),
+    )
     id = db.Column(db.String(50), primary_key=True, default=shortuuid.uuid)
     status = db.Column(db.Integer, default=1)
     created = db.Column(db.DateTime, default=datetime.now)
+    # 最后一次状态变化的时间，精确到毫秒，落库时只接受比它更新的变化，为空时以created为准
+    updated = db.Column(DATETIME(fsp=3))
 
     comment_id = db.Column(db.String(50), db.ForeignKey("comments.id"))
     user_id = db.Column(db.String(50), db.ForeignKey("front_user.id"))
@@ -55,6 +71,8 @@ class Notification(db.Model):
 
     sender_id = db.Column(db.String(50), db.ForeignKey("front_user.id"))
     acceptor_id = db.Column(db.String(50), db.ForeignKey("front_user.id"))
+    # 点赞通知的去重键"类型:发送者id:文章/评论id"，多个消费者重复落库同一个赞时只会插入一条通知，其他通知为空
+    unique_key = db.Column(db.String(120), unique=True)
 
     sender = db.relationship("FrontUser", backref="broadcasts", foreign_keys=[sender_id])
     acceptor = db.relationship("FrontUser", backref="notifications", foreign_keys=[acceptor_id])
@@ -128,6 +146,24 @@ class FrontUser(db.Model):
     followers = db.relationship("Follow", foreign_keys=[Follow.followed_id], lazy="dynamic",
                                 backref=db.backref("followed", lazy="joined"), cascade="all, delete-orphan")
 
+    def card(self):
+        return {
+            "author_id": self.id,
+            "username": self.username,
+            "avatar": self.avatar,
+            "gender": self.gender,
+            "signature": self.signature
+        }
+
+    @staticmethod
+    def get_cards(*user_ids):
+        """
+        从进程内缓存中批量取出用户的公开资料，返回以用户id为键的字典
+        用户修改资料后需要调用author_local.invalidate(user_id)
+        """
+        return author_local.get_many(user_ids, lambda missing: {
+            user.id: user.card() for user in FrontUser.query.filter(FrontUser.id.in_(missing))})
+
     def has_permission(self, permission, model=None):
         # 通常来说，前端用户仅需要判断是否拥有三个权限，VISITOR,COMMENTER,POSTER
         # 这三个权限为传入的permission可能值
@@ -161,77 +197,72 @@ class FrontUser(db.Model):
                 return False
         return False
 
+    # 用户点赞集合中的占位元素，没有点过赞的用户也会缓存一个只含占位元素的集合，不会每次都去查数据库
+    APPRECIATION_SENTINEL = "_"
+
+    @staticmethod
+    def appreciation_name(user_id):
+        return "liked:{}".format(user_id)
+
     def get_all_appreciation(self, cache, attr):
         """
-        从缓存中获取用户所有点的数据，如果缓存中获取不到，把数据库中的内容更新到缓存中
+        从缓存中获取用户点过赞的文章/评论id集合，如果缓存中获取不到，把数据库中的内容更新到缓存中
         如果是对文章操作，attr的值应该为likes
         如果是对评论操作，attr的值应该为rates
         """
-        user_data = cache.get(self.id, json=True)
+        user_data = cache.set_members(FrontUser.appreciation_name(self.id))
         if not user_data:
-            user_data = self.set_all_appreciation(cache, attr)
+            return self.set_all_appreciation(cache, attr)
+        user_data.discard(FrontUser.APPRECIATION_SENTINEL)
         return user_data
 
     def set_all_appreciation(self, cache, attr):
         """
         用于将用户的点赞请求缓存到数据库中
         """
-        user_data = {}
-        foreign_key = "article_id" if attr == "likes" else "comment_id"
+        return FrontUser.set_appreciations(cache, attr, [self.id])[self.id]
+
+    @staticmethod
+    def set_appreciations(cache, attr, user_ids):
+        """
+        从数据库重建一组用户的点赞集合，用一条IN查询取出所有有效的赞，结果用一次pipeline写回
+        返回以用户id为键、点过赞的文章/评论id集合为值的字典
+        """
+        model, foreign_key = (Like, Like.article_id) if attr == "likes" else (Rate, Rate.comment_id)
+        res = {user_id: set() for user_id in user_ids}
+        for user_id, attr_id in db.session.query(model.user_id, foreign_key)\
+                .filter(model.user_id.in_(user_ids), model.status == 1):
+            res[user_id].add(attr_id)
         with cache.redis.pipeline(transaction=False) as pipeline:
-            for attr_item in getattr(self, attr).all():             # for item in self.likes.all()
-                if attr_item.status:
-                    foreign_id = getattr(attr_item, foreign_key)    # article_id = item.article_id
-                    attr_value = {
-                        "id": attr_item.id,                         # attr_value["id"] = item.id
-                        "status": 1,
-                        "created": attr_item.created.timestamp()
-                    }
-                    user_data[foreign_id] = attr_value              # user_data["article_id"] = item_value
-                    attr_value = json.dumps(attr_value)             # json.loads
-                    pipeline.hset(self.id, foreign_id, attr_value)  # hset(user_id, article_id, item_value)
-            pipeline.expire(self.id, 3600)
+            for user_id, user_data in res.items():
+                name = FrontUser.appreciation_name(user_id)
+                pipeline.delete(name)
+                pipeline.sadd(name, FrontUser.APPRECIATION_SENTINEL, *user_data)
+                pipeline.expire(name, cache.expire_time())
             pipeline.execute()
-        return user_data
+        return res
 
     def set_one_appreciation(self, cache, sub_cache, attr, attr_id):
         """
         用于用户对单个文章/评论进行赞操作
         """
-        # 首先去查询是否有用户的赞过的文章/评论的缓存,如果没有就把他添加到缓存中
-        if not cache.exists(self.id):
+        # 在一次原子操作中切换点赞状态，并把变化记录在队列中，用于后期数据库统一更新点赞情况
+        # 如果用户的点赞缓存不存在，先从数据库重建再切换，重建后即使用户没有点过赞也直接写入
+        # 时间戳精确到毫秒，落库时用它判断同一秒内多次切换的先后
+        cur_timestamp = round(datetime.now().timestamp(), 3)
+        args = dict(name=FrontUser.appreciation_name(self.id), key=attr_id, user_id=self.id,
+                    timestamp=cur_timestamp, sentinel=FrontUser.APPRECIATION_SENTINEL)
+        status = cache.toggle_appreciation(**args)
+        if status is None:
             self.set_all_appreciation(cache, attr)
+            status = cache.toggle_appreciation(force=True, **args)
 
-        # 从缓存中获取用户对某一文章/评论的点赞情况
-        attr_value = cache.get_pointed(self.id, attr_id, json=True)[0]
-
-        # 获取现在的时间
-        cur_timestamp = int(datetime.now().timestamp())
-
-        # 如果获取不到，说明这是一个新的点赞请求，用户以前没有对该文章/评论点过赞，于是新建一个赞
-        if not attr_value:
-            attr_value = {
-                "id": shortuuid.uuid(),
-                "status": 0,
-            }
-
-        # 将点赞情况中的status置为其反面, 并将其储存进缓存中
-        attr_value["status"] = 1 - attr_value["status"]
-        attr_value["created"] = cur_timestamp
-        cache.set_pointed(self.id, attr_id, attr_value, json=True)
-
-        # 更新子缓存数据
-        amount = 1 if attr_value["status"] else -1
-        sub_cache.hincrby(attr_id, attr, amount)
-
-        # 状态变化过的点赞要记录在一个队列中，用于后期数据库统一更新点赞情况
-        new_attr_value = {
-            "id": attr_id,
-            "user_id": self.id,
-            "status": attr_value["status"],
-            "created": cur_timestamp
-        }
-        cache.set_pointed(name="queue", key=attr_value["id"], value=new_attr_value, json=True)
+        # 更新子缓存数据，子缓存与用户点赞缓存不在同一个库中，需要单独一次往返
+        # 子缓存不存在时不创建，等到下次读取时再从数据库重建
+        amount = 1 if status else -1
+        sub_cache.hincrby_if_exists(attr_id, attr, amount)
+        if attr == "likes":
+            hot_rank.bump(attr_id, attr, amount)
 
     def follow(self, user):
         follow = self.followeds.filter_by(followed_id=user.id).first()
@@ -251,11 +282,20 @@ class FrontUser(db.Model):
         return self.followers.filter_by(follower_id=user.id).first() is not None
 
     def set_new_notifications_count(self, cache):
-        notifications = Notification.query.filter_by(acceptor_id=self.id, visited=0)
-        count = notifications.with_entities(func.count(Notification.id)).scalar()
-        res = dict(new=count)
-        cache.set(self.id, res)
-        return count
+        return FrontUser.set_new_notifications_counts(cache, [self.id])[self.id]
+
+    @staticmethod
+    def set_new_notifications_counts(cache, user_ids):
+        """
+        用一条GROUP BY查询统计一组用户的未读通知数，结果用一次pipeline写回
+        返回以用户id为键的字典
+        """
+        counts = dict(db.session.query(Notification.acceptor_id, func.count(Notification.id))
+                      .filter(Notification.acceptor_id.in_(user_ids), Notification.visited == 0)
+                      .group_by(Notification.acceptor_id))
+        res = {user_id: counts.get(user_id, 0) for user_id in user_ids}
+        cache.set_many({user_id: dict(new=count) for user_id, count in res.items()})
+        return res
 
     def get_new_notifications_count(self, cache):
         if not cache.exists(self.id):
@@ -263,7 +303,5 @@ class FrontUser(db.Model):
         return cache.get_pointed(self.id, "new")[0]
 
     def notification_increase(self, cache, amount=1):
-        if not cache.exists(self.id):
+        if cache.hincrby_if_exists(self.id, "new", amount) is None:
             self.set_new_notifications_count(cache)
-        else:
-            cache.hincrby(self.id, "new", amount)
@@ -1,18 +1,27 @@
 from flask import Blueprint, request, g
-from sqlalchemy import func
-from flask_restful import Resource, Api, fields, marshal_with
+from sqlalchemy import func, or_, and_
+from flask_restful import Resource, Api, fields
+from sqlalchemy.orm import undefer
 from common.token import login_required, Permission
 from common.models import Board, Article, Tag
 from common.cache import like_cache, article_cache
+from common.counter import article_counter, track_article
+from common.ranking import hot_rank
+from common.feed import feed_generation, get_feed, set_feed, invalidate_feed
+from common.serializer import Serializer, envelope, output_json
 from common.hooks import hook_front
+from common.cursor import encode_cursor, decode_cursor
+from common.exceptions import ArgumentsError
 from exts import db
 from common.restful import *
 from ..forms import ArticleForm
+from ..models import FrontUser
 import flask_whooshalchemyplus
 
 
 article_bp = Blueprint("article", __name__, url_prefix="/api/article")
 api = Api(article_bp)
+api.representations["application/json"] = output_json
 
 
 class PutView(Resource):
@@ -49,17 +58,21 @@ class PutView(Resource):
         tags = Tag.query_tags(*form.tags.data)
         images = ",".join([image + g.IMAGE_PIC for image in form.images.data])
 
-        article = Article(title=title, content=content,
+        article = Article(title=title, content=content, excerpt=Article.make_excerpt(content),
                           images=images, board_id=board_id,
                           author_id=g.user.id)
         article.board = board
         article.author = g.user
         article.add_tags(*tags)
 
-        db.session.add(article)
-        db.session.commit()
+        with track_article(article):
+            db.session.add(article)
+            db.session.commit()
+        hot_rank.add(article)
+        invalidate_feed(board_id)
 
-        flask_whooshalchemyplus.index_one_model(Article)
+        # 只为新文章建立全文索引，index_one_model会遍历整张表，并为每篇文章单独加载延迟加载的content
+        flask_whooshalchemyplus.index_one_record(article)
 
         return success()
 
@@ -82,6 +95,7 @@ class QueryView(Resource):
                 "images": fields.List(fields.String),   # 文章图片
                 "likes": fields.Integer,                # 点赞数
                 "views": fields.Integer,                # 浏览数
+                "unique_views": fields.Integer,         # 独立访客数，未开启独立访客统计时为-1
                 "comments": fields.Integer,             # 评论数
                 "liked": fields.Boolean,                # 是否喜欢文章
                 "quality": fields.Integer,              # 是否精品
@@ -103,8 +117,10 @@ class QueryView(Resource):
                 })
             })),
             "total": fields.Integer,
+            "cursor": fields.String,                    # 下一页的游标
         })
     }
+    serializer = Serializer(resource_fields)
 
     method_decorators = [login_required(Permission.VISITOR)]
 
@@ -116,90 +132,137 @@ class QueryView(Resource):
         mode=hot      按热度排序
         :board_id   板块id，当其为0时不进行板块区分
         :quality    为1时只查询精品帖子
+        :cursor     mode=new时可用，传入上一页返回的游标获取下一页，第一页传空字符串
+                    不传cursor时仍然按照offset与limit分页
         """
         mode = request.args.get("mode")
 
         if mode not in ("hot", "new"):
             return params_error(message="不存在的排序方式")
 
+        board_id = request.args.get("board_id", 0, type=int)
+        if board_id and not Board.get_cards(board_id):
+            return source_error(message="板块不存在")
+
+        quality = 1 if request.args.get("quality", 0, type=int) else 0
+        offset = request.args.get("offset", 0, type=int)
+        limit = request.args.get("limit", 20, type=int)
+        if limit <= 0 or offset < 0:
+            return params_error(message="分页参数错误")
+
+        # 各个列表的第一页被所有用户共享，直接从缓存中取出，只需要按当前用户填充liked字段
+        first_page = not offset and not request.args.get("cursor")
+        if first_page:
+            generation = feed_generation(board_id)
+            data = get_feed(mode, board_id, quality, limit, generation)
+            if data:
+                return self.overlay_liked(data)
+
         if mode == "new":
-            board_id = request.args.get("board_id", 0, type=int)
             # 板块id不等于0->按照板块id进行查询
             if board_id:
-                board = Board.query.get(board_id)
-                if not board:
-                    return source_error(message="板块不存在")
                 articles = Article.query.filter_by(board_id=board_id, status=1)
             # 板块id等于0->查询所有的帖子
             else:
                 articles = Article.query.filter_by(status=1)
 
-            quality = request.args.get("quality", 0, type=int)
             if quality:
                 articles = articles.filter_by(quality=1)
 
-            offset = request.args.get("offset", 0, type=int)
-            limit = request.args.get("limit", 20, type=int)
+            cursor = request.args.get("cursor")
+
+            total = article_counter.get(1, board_id, quality)
+            articles = articles.order_by(Article.created.desc(), Article.id.desc())
+
+            # 游标分页：直接从上一页最后一篇文章的(created, id)之后开始取，不再扫描并丢弃offset行
+            if cursor is not None:
+                if cursor:
+                    try:
+                        created, article_id = decode_cursor(cursor)
+                    except ArgumentsError as e:
+                        return params_error(message=e.message)
+                    articles = articles.filter(or_(Article.created < created,
+                                                   and_(Article.created == created, Article.id < article_id)))
+                articles = articles.limit(limit).all()
+            else:
+                articles = articles[offset: offset+limit]
 
-            total = articles.with_entities(func.count(Article.id)).scalar()
-            articles = articles.order_by(Article.created.desc())[offset: offset+limit]
-            return self.generate_response(articles, total)
+            next_cursor = None
+            if articles and len(articles) == limit:
+                next_cursor = encode_cursor(articles[-1].created, articles[-1].id)
+            res = self.generate_response(articles, total, next_cursor)
 
         # 按照热度进行排序
+        # 板块与精品各自有独立的热榜，按照board_id与quality选择
         elif mode == "hot":
-            article_ids = article_cache.get_pointed("hot", "rank", json=True)[0]
-            articles = Article.query.filter(Article.id.in_(article_ids), Article.status == 1)
-            total = articles.with_entities(func.count(Article.id)).scalar()
-            return self.generate_response(articles, total)
+            article_ids = hot_rank.page(offset, limit, board_id, quality)
+            articles = {article.id: article for article in Article.query.filter(Article.id.in_(article_ids))} \
+                if article_ids else {}
+
+            # 计算排行之后被删除的文章，顺手从排行中移除，总数直接取有序集合的大小
+            deleted = [article_id for article_id in article_ids
+                       if article_id not in articles or not articles[article_id].status]
+            hot_rank.remove(*deleted)
+            articles = [articles[article_id] for article_id in article_ids if article_id not in deleted]
+            total = hot_rank.count(board_id, quality)
+            res = self.generate_response(articles, total)
+
+        else:
+            return params_error(message="你到达了世界尽头")
+
+        if first_page:
+            set_feed(mode, board_id, quality, limit, generation, res["data"])
+        return res
 
-        return params_error(message="你到达了世界尽头")
+    @staticmethod
+    def overlay_liked(data):
+        """
+        在共享的列表数据上填充当前用户的liked字段，并包装成与generate_response一致的响应
+        """
+        user_likes = g.user.get_all_appreciation(cache=like_cache, attr="likes")
+        for article in data["articles"]:
+            article["liked"] = Article.in_likes(article["article_id"], user_likes)
+        return envelope(data)
 
     @staticmethod
-    @marshal_with(resource_fields)
-    def generate_response(articles, total):
+    def generate_response(articles, total, cursor=None, full=False):
         """
         生成文章列表类型的返回数据
+        SearchView, TagQueryView, LikesView, PostsView等视图都通过这里生成响应
+        列表中content字段只返回摘要，full为True时返回完整正文
         """
-        resp = Data()
-        resp.articles = []
-        resp.total = total
+        resp = {
+            "articles": [],
+            "total": total,
+            "cursor": cursor
+        }
         user_likes = g.user.get_all_appreciation(cache=like_cache, attr="likes")
-        for article in articles:
-            data = Data()
-            data.article_id = article.id
-            data.title = article.title
-            data.created = article.created.timestamp()
-            data.content = article.content
-            data.quality = article.quality
-
-            article_properties = article.get_property_cache(article_cache)
-            data.likes = article_properties.get("likes", -1)
-            data.views = article_properties.get("views", -1)
-            data.comments = article_properties.get("comments", -1)
-
-            data.liked = article.is_liked(user_likes)
-
-            data.board = Data()
-            data.board.board_id = article.board.id
-            data.board.name = article.board.name
-            data.board.avatar = article.board.avatar
-
-            data.author = Data()
-            data.author.author_id = article.author_id
-            data.author.username = article.author.username
-            data.author.avatar = article.author.avatar
-            data.author.gender = article.author.gender
-
-            if article.images:
-                data.images = article.images.split(",")
-            else:
-                data.images = []
 
-            data.tags = [tag.marshal(Data) for tag in article.tags]
-
-            resp.articles.append(data)
-
-        return Response.success(data=resp)
+        # 板块、作者与标签很少变化，从进程内缓存中批量取出，属性缓存整页一次从redis取出
+        boards = Board.get_cards(*{article.board_id for article in articles})
+        authors = FrontUser.get_cards(*{article.author_id for article in articles})
+        tags = Article.get_tag_cards(*[article.id for article in articles])
+        properties = Article.get_property_caches(article_cache, articles)
+        for article in articles:
+            article_properties = properties[article.id]
+            resp["articles"].append({
+                "article_id": article.id,
+                "title": article.title,
+                "created": article.created.timestamp(),
+                "content": article.content if full else article.get_excerpt(),
+                "quality": article.quality,
+                "likes": article_properties.get("likes", -1),
+                "views": article_properties.get("views", -1),
+                "unique_views": article_properties.get("unique_views", -1),
+                "comments": article_properties.get("comments", -1),
+                "liked": article.is_liked(user_likes),
+                "board": boards.get(article.board_id),
+                "author": authors.get(article.author_id),
+                "images": article.image_list,
+                "tags": tags[article.id]
+            })
+
+        return QueryView.serializer.success(resp)
 
 
 class DeleteView(Resource):
@@ -228,9 +291,11 @@ class DeleteView(Resource):
         if article.quality and not g.user.has_permission(Permission.FRONTUSER):
             return auth_error(message="普通用户无法删除精品贴")
 
-        article.status = 0
-
-        db.session.commit()
+        with track_article(article):
+            article.status = 0
+            db.session.commit()
+        hot_rank.remove(article_id)
+        invalidate_feed(article.board_id)
         return success()
 
 
@@ -264,12 +329,44 @@ class PointedView(Resource):
         article_id = request.args.get("article_id")
         if not article_id:
             return params_error(message="缺失文章id")
-        article = Article.query.get(article_id)
+        article = Article.query.options(undefer("content")).get(article_id)
         if not article or not article.status:
             return source_error(message="文章不存在")
-        res = QueryView.generate_response(total=1, articles=[article])
+        res = QueryView.generate_response(total=1, articles=[article], full=True)
         res["data"]["article"] = res["data"].pop("articles")[0]
         res["data"].pop("total")
+        res["data"].pop("cursor")
+        return res
+
+
+class BatchView(Resource):
+    """
+    批量返回指定文章信息，文章按照请求中的顺序返回
+    不存在或已删除的文章在对应位置返回{"article_id": id, "missing": true}
+    """
+
+    method_decorators = [login_required(Permission.VISITOR)]
+
+    max_articles = 20
+
+    def get(self):
+        """
+        :article_ids    以逗号分隔的文章id
+        """
+        article_ids = [article_id for article_id in request.args.get("article_ids", "").split(",") if article_id]
+        if not article_ids:
+            return params_error(message="缺失文章id")
+        if len(article_ids) > self.max_articles:
+            return params_error(message="一次最多查询{}篇文章".format(self.max_articles))
+
+        articles = Article.query.options(undefer("content"))\
+            .filter(Article.id.in_(set(article_ids)), Article.status == 1).all()
+        res = QueryView.generate_response(articles, len(articles), full=True)
+        found = {article["article_id"]: article for article in res["data"].pop("articles")}
+        res["data"]["articles"] = [dict(found[article_id], missing=False) if article_id in found
+                                   else {"article_id": article_id, "missing": True}
+                                   for article_id in article_ids]
+        res["data"].pop("cursor")
         return res
 
 
@@ -309,8 +406,11 @@ class QualityView(Resource):
         if not article or not article.status:
             return source_error(message="文章不存在")
 
-        article.quality = 1 - article.quality
-        db.session.commit()
+        with track_article(article):
+            article.quality = 1 - article.quality
+            db.session.commit()
+        hot_rank.set_quality(article)
+        invalidate_feed(article.board_id)
         return success()
 
 
@@ -341,6 +441,7 @@ api.add_resource(QueryView, "/query/", endpoint="front_article_query")
 api.add_resource(DeleteView, "/delete/", endpoint="front_article_delete")
 api.add_resource(LikeArticleView, "/like/", endpoint="front_article_like")
 api.add_resource(PointedView, "/pointed/", endpoint="front_article_pointed")
+api.add_resource(BatchView, "/batch/", endpoint="front_article_batch")
 api.add_resource(SearchView, "/search/", endpoint="front_article_search")
 api.add_resource(QualityView, "/quality/", endpoint="front_article_quality")
 api.add_resource(TagQueryView, "/tag/", endpoint="front_article_tag")
@@ -1,13 +1,14 @@
 from flask import Blueprint
 from flask_restful import Resource, Api, fields, marshal_with
-from sqlalchemy import func
 from common.models import Board
 from common.token import login_required, Permission
 from common.restful import Response, Data
 from common.hooks import hook_front
+from common.serializer import output_json
 
 board_bp = Blueprint("board", __name__, url_prefix="/api/board")
 api = Api(board_bp)
+api.representations["application/json"] = output_json
 
 
 class BoardView(Resource):
@@ -39,33 +40,12 @@ class BoardView(Resource):
         """
         data = Data()
 
-        # status的值用于筛选对应status值的boards，1为可见，0为不可见
-        boards = Board.query.filter_by(status=1)
-        # 用切片筛选结果
-        res = boards.all()
-
-        # 优化后的sql count函数
-        total = boards.with_entities(func.count(Board.id)).scalar()
-        data.total = total
-        data.boards = []
-        for board in res:
-            data.boards.append(self.generate_board(board))
+        # 可见的板块很少变化，从进程内缓存中取出，板块被修改时所有进程一起失效
+        boards = Board.get_visible_cards()
+        data.total = len(boards)
+        data.boards = boards
         return Response.success(data=data)
 
-    @staticmethod
-    def generate_board(board):
-        """
-        返回一个格式化的board数据对象
-        :param board:
-        :return:
-        """
-        data = Data()
-        data.name = board.name
-        data.board_id = board.id
-        data.desc = board.desc
-        data.avatar = board.avatar
-        return data
-
 
 api.add_resource(BoardView, '/', endpoint="front_board_query")
 
@@ -1,11 +1,12 @@
 from flask import Blueprint, request, g
-from sqlalchemy import func
-from flask_restful import Resource, Api, fields, marshal_with
+from flask_restful import Resource, Api, fields
 from common.restful import *
 from common.hooks import hook_front
 from common.token import login_required, Permission
 from common.models import Article, Comment, SubComment
 from common.cache import article_cache, rate_cache, comment_cache, notify_cache
+from common.counter import comment_counter, sub_comment_counter, notify_counter
+from common.serializer import Serializer, output_json
 from ..forms import CommentForm, SubCommentForm
 from ..models import FrontUser, Notification
 from exts import db
@@ -14,6 +15,7 @@ import shortuuid
 
 comment_bp = Blueprint("comment", __name__, url_prefix="/api/comment")
 api = Api(comment_bp)
+api.representations["application/json"] = output_json
 
 
 class CommentPutView(Resource):
@@ -53,10 +55,12 @@ class CommentPutView(Resource):
             notification.acceptor = article.author
             db.session.add(notification)
             article.author.notification_increase(notify_cache)
+            notify_counter.increase((article.author_id, ))
 
         db.session.add(comment)
         db.session.commit()
         article.cache_increase(article_cache, field="comments")
+        comment_counter.increase((article_id, ))
         return success()
 
 
@@ -82,6 +86,7 @@ class CommentDeleteView(Resource):
         comment.status = 0
         db.session.commit()
         comment.article.cache_increase(article_cache, field="comments", amount=-1)
+        comment_counter.increase((comment.article_id, ), amount=-1)
         return success()
 
 
@@ -115,6 +120,7 @@ class CommentQueryView(Resource):
             "total": fields.Integer
         })
     }
+    serializer = Serializer(resource_fields)
 
     method_decorators = [login_required(Permission.VISITOR)]
 
@@ -131,16 +137,15 @@ class CommentQueryView(Resource):
             return source_error(message="文章不存在")
 
         comments = article.comments.filter_by(status=1)
-        total = comments.with_entities(func.count(Comment.id)).scalar()
+        total = comment_counter.get(article_id)
         comments = comments.order_by(Comment.created.asc())[offset:offset+limit]
 
         if not offset:
-            article.cache_increase(article_cache, field="views")
+            article.add_view(article_cache, g.user.id)
 
         return self.generate_response(comments, total)
 
     @staticmethod
-    @marshal_with(resource_fields)
     def generate_response(comments, total):
         """
         返回评论类响应
@@ -148,35 +153,32 @@ class CommentQueryView(Resource):
         :param total:
         :return:
         """
-        resp = Data()
-        resp.total = total
-        resp.comments = []
+        resp = {
+            "total": total,
+            "comments": []
+        }
         user_rates = g.user.get_all_appreciation(cache=rate_cache, attr="rates")
+        # 整页评论的属性缓存用一次pipeline取出
+        properties = Comment.get_property_caches(comment_cache, comments)
         for comment in comments:
-            data = Data()
-            data.content = comment.content or ""
-            data.created = comment.created.timestamp()
-            data.comment_id = comment.id
-            data.rated = comment.is_rated(user_rates)
-
-            comment_properties = comment.get_property_cache(comment_cache)
-            data.rates = comment_properties["rates"]
-            data.sub_comments = comment_properties["sub_comments"]
-
-            data.author = Data()
-            data.author.author_id = comment.author_id
-            data.author.username = comment.author.username
-            data.author.avatar = comment.author.avatar
-            data.author.gender = comment.author.gender
-            data.author.signature = comment.author.signature
-
-            if comment.images:
-                data.images = comment.images.split(",")
-            else:
-                data.images = []
-
-            resp.comments.append(data)
-        return Response.success(data=resp)
+            comment_properties = properties[comment.id]
+            resp["comments"].append({
+                "content": comment.content or "",
+                "created": comment.created.timestamp(),
+                "comment_id": comment.id,
+                "rated": comment.is_rated(user_rates),
+                "rates": comment_properties["rates"],
+                "sub_comments": comment_properties["sub_comments"],
+                "author": {
+                    "author_id": comment.author_id,
+                    "username": comment.author.username,
+                    "avatar": comment.author.avatar,
+                    "gender": comment.author.gender,
+                    "signature": comment.author.signature
+                },
+                "images": comment.images.split(",") if comment.images else []
+            })
+        return CommentQueryView.serializer.success(resp)
 
 
 class SubCommentPutView(Resource):
@@ -219,10 +221,12 @@ class SubCommentPutView(Resource):
             notification.sender = g.user
             db.session.add(notification)
             acceptor.notification_increase(notify_cache)
+            notify_counter.increase((acceptor_id, ))
 
         db.session.add(sub_comment)
         db.session.commit()
         comment.cache_increase(comment_cache, field="sub_comments")
+        sub_comment_counter.increase((comment_id, ))
         return success()
 
 
@@ -248,6 +252,7 @@ class SubCommentDeleteView(Resource):
         sub_comment.status = 0
         db.session.commit()
         sub_comment.comment.cache_increase(comment_cache, field="sub_comments", amount=-1)
+        sub_comment_counter.increase((sub_comment.comment_id, ), amount=-1)
         return success()
 
 
@@ -282,6 +287,7 @@ class SubCommentQueryView(Resource):
             "total": fields.Integer
         })
     }
+    serializer = Serializer(resource_fields)
 
     method_decorators = [login_required(Permission.VISITOR)]
 
@@ -298,35 +304,34 @@ class SubCommentQueryView(Resource):
             return source_error(message="评论不存在")
 
         sub_comments = comment.sub_comments.filter_by(status=1)
-        total = sub_comments.with_entities(func.count(SubComment.id)).scalar()
+        total = sub_comment_counter.get(comment_id)
         sub_comments = sub_comments.order_by(SubComment.created.asc())[offset:offset + limit]
         return self._generate_response(sub_comments, total)
 
-    @marshal_with(resource_fields)
     def _generate_response(self, sub_comments, total):
-        resp = Data()
-        resp.total = total
-        resp.sub_comments = []
+        resp = {
+            "total": total,
+            "sub_comments": []
+        }
         for sub_comment in sub_comments:
-            data = Data()
-            data.content = sub_comment.content
-            data.created = sub_comment.created.timestamp()
-            data.sub_comment_id = sub_comment.id
-
-            data.author = Data()
-            data.author.author_id = sub_comment.author_id
-            data.author.username = sub_comment.author.username
-            data.author.avatar = sub_comment.author.avatar
-            data.author.gender = sub_comment.author.gender
-
-            data.acceptor = Data()
-            data.acceptor.acceptor_id = sub_comment.acceptor_id
-            data.acceptor.username = sub_comment.acceptor.username
-            data.acceptor.avatar = sub_comment.acceptor.avatar
-            data.acceptor.gender = sub_comment.acceptor.gender
-
-            resp.sub_comments.append(data)
-        return Response.success(data=resp)
+            resp["sub_comments"].append({
+                "content": sub_comment.content,
+                "created": sub_comment.created.timestamp(),
+                "sub_comment_id": sub_comment.id,
+                "author": {
+                    "author_id": sub_comment.author_id,
+                    "username": sub_comment.author.username,
+                    "avatar": sub_comment.author.avatar,
+                    "gender": sub_comment.author.gender
+                },
+                "acceptor": {
+                    "acceptor_id": sub_comment.acceptor_id,
+                    "username": sub_comment.acceptor.username,
+                    "avatar": sub_comment.acceptor.avatar,
+                    "gender": sub_comment.acceptor.gender
+                }
+            })
+        return self.serializer.success(resp)
 
 
 class RateCommentView(Resource):
@@ -3,11 +3,13 @@ from flask_restful import Resource, Api, fields, marshal_with
 from common.restful import Response, Data
 from common.image_uploader import generate_uptoken
 from common.hooks import hook_front
+from common.serializer import output_json
 from common.token import login_required, Permission
 
 
 common_bp = Blueprint("common", __name__, url_prefix="/api/common")
 api = Api(common_bp)
+api.representations["application/json"] = output_json
 
 
 class ImageView(Resource):
@@ -3,7 +3,9 @@ from flask_restful import Resource, Api, fields, marshal_with
 from common.restful import *
 from common.token import generate_token, login_required, Permission
 from common.hooks import hook_front
-from common.cache import notify_cache, like_cache, front_cache
+from common.serializer import output_json
+from common.cache import notify_cache, like_cache, front_cache, author_local
+from common.counter import post_counter, notify_counter
 from common.models import Article
 from ..forms import *
 from sqlalchemy import func
@@ -15,6 +17,7 @@ import common.wxapi as wxapi
 
 user_bp = Blueprint("user", __name__, url_prefix="/api/user")
 api = Api(user_bp)
+api.representations["application/json"] = output_json
 
 
 class WXLoginView(Resource):
@@ -157,6 +160,7 @@ class WXUserInfoView(Resource):
         user.avatar = avatar
         user.gender = gender
         db.session.commit()
+        author_local.invalidate(user.id)
 
         return self.generate_response(user)
 
@@ -217,6 +221,7 @@ class ProfileView(Resource):
         g.user.gender = gender
 
         db.session.commit()
+        author_local.invalidate(g.user.id)
         return success()
 
     @marshal_with(resource_fields)
@@ -297,8 +302,7 @@ class LikesView(Resource):
         limit = request.args.get("limit", 10, type=int)
 
         user_likes = g.user.get_all_appreciation(cache=like_cache, attr="likes")
-        article_ids = [article_id for article_id in user_likes.keys() if user_likes[article_id]["status"]]
-        articles = Article.query.filter(Article.id.in_(article_ids), Article.status == 1)
+        articles = Article.query.filter(Article.id.in_(user_likes), Article.status == 1)
         total = articles.with_entities(func.count(Article.id)).scalar()
         articles = articles.order_by(Article.created.desc())[offset:offset+limit]
         return ArticleQueryView.generate_response(articles, total)
@@ -319,7 +323,7 @@ class PostsView(Resource):
         offset = request.args.get("offset", 0, type=int)
         limit = request.args.get("limit", 10, type=int)
         articles = user.articles.filter_by(status=1)
-        total = articles.with_entities(func.count(Article.id)).scalar()
+        total = post_counter.get(user_id)
         articles = articles.order_by(Article.created.desc())[offset: offset + limit]
         return ArticleQueryView.generate_response(articles, total)
 
@@ -355,7 +359,7 @@ class NotifyView(Resource):
         offset = request.args.get("offset", 0, type=int)
         limit = request.args.get("limit", 10, type=int)
         notifications = Notification.query.filter_by(acceptor_id=g.user.id).order_by(Notification.created.desc())
-        total = notifications.with_entities(func.count(Notification.id)).scalar()
+        total = notify_counter.get(g.user.id)
         notifications = notifications[offset:offset+limit]
         return self._generate_response(total, notifications)
 
@@ -3,7 +3,15 @@ from app import app
 from exts import db
 from flask_migrate import Migrate, MigrateCommand
 from cms.models import CMSUser
+from common.models import Article
+from sqlalchemy.orm import undefer
 from common.exceptions import DIYException
+from common.ranking import Candidates, ScoreEngine
+from common.schedule import warm_caches, remove_duplicate_appreciations
+from front.models import Like, Rate
+from common.cache import like_cache, rate_cache
+from datetime import datetime
+import time
 
 
 manager = Manager(app)
@@ -65,5 +73,87 @@ def check_cms_user(username, password):
         print('cms用户验证过程中产生错误，验证失败...')
 
 
+@manager.option('-c', '--chunk', dest='chunk', type=int, default=500)
+def fill_excerpts(chunk):
+    """
+    为还没有摘要的旧文章生成摘要
+    :param chunk: 每批处理的文章数量
+    :return:
+    """
+    count = 0
+    while True:
+        articles = Article.query.options(undefer("content")).filter(Article.excerpt.is_(None)).limit(chunk).all()
+        if not articles:
+            break
+        for article in articles:
+            article.excerpt = Article.make_excerpt(article.content)
+        db.session.commit()
+        count += len(articles)
+        print("已经生成了【{}】篇文章的摘要...".format(count))
+
+
+@manager.option('-n', '--size', dest='size', type=int, default=50000)
+@manager.option('-k', '--top', dest='top', type=int, default=10)
+def bench_ranking(size, top):
+    """
+    用随机生成的候选文章离线压测热度打分引擎，不需要连接数据库
+    :param size: 候选文章数量
+    :param top: 取前多少名
+    :return:
+    """
+    now = datetime.now()
+    candidates = Candidates.random(size, now, seed=0)
+    engine = ScoreEngine.from_config()
+    t1 = time.time()
+    ids, scores = engine.rank(candidates, k=top)
+    t2 = time.time()
+    print("{}篇文章打分并取前{}名耗时【{:.3f}】ms".format(size, top, (t2 - t1) * 1000))
+    for article_id, score in zip(ids, scores):
+        print(article_id, score)
+
+
+@manager.option('-a', '--articles', dest='articles', type=int, default=2000)
+@manager.option('-u', '--users', dest='users', type=int, default=2000)
+@manager.option('-d', '--days', dest='days', type=int, default=7)
+@manager.option('-c', '--chunk', dest='chunk', type=int, default=500)
+def warm_cache(articles, users, days, chunk):
+    """
+    部署或redis重启后预热缓存，已经存在的缓存不会被覆盖
+    :param articles: 预热最新与最热的文章数量
+    :param users: 预热的活跃用户数量
+    :param days: 多少天内有过互动的用户算作活跃用户
+    :param chunk: 每批处理的数量
+    :return:
+    """
+    t1 = time.time()
+    count = warm_caches(articles=articles, users=users, days=days, chunk=chunk)
+    t2 = time.time()
+    print("缓存预热完毕...共写入【{}】条缓存...总耗时【{:.3f}】s".format(count, t2 - t1))
+
+
+@manager.command
+def queue_stats():
+    """
+    查看点赞队列的积压情况
+    :return:
+    """
+    for name, cache in (("文章点赞", like_cache), ("评论点赞", rate_cache)):
+        stats = cache.stream().stats()
+        print("【{}】共【{length}】条...已读取未确认【{pending}】条...未读取【{undelivered}】条...最早的消息已等待【{lag:.1f}】s"
+              .format(name, **stats))
+
+
+@manager.option('-c', '--chunk', dest='chunk', type=int, default=500)
+def dedup_appreciations(chunk):
+    """
+    清理历史遗留的重复赞，在建立点赞表的唯一索引之前执行
+    :param chunk: 每批处理的(用户, 文章/评论)数量
+    :return:
+    """
+    for name, model, foreign_key in (("文章点赞", Like, "article_id"), ("评论点赞", Rate, "comment_id")):
+        count = remove_duplicate_appreciations(model, foreign_key, chunk=chunk)
+        print("【{}】删除了【{}】条重复的赞...".format(name, count))
+
+
 if __name__ == '__main__':
     manager.run()